@@ -0,0 +1,50 @@
+"""
+Circadian lighting helpers - sun elevation computed fully offline and daily color temperature/brightness table
+derived from it. Table is reduced to change points, where the target moves past perceptual delta,
+so lights are updated with bounded, minimal number of commands.
+
+For more info read README.md
+"""
+from math import asin, atan2, cos, degrees, radians, sin
+
+
+# Sun elevation in degrees at given location and unix time (low precision solar position, error below 1 degree)
+def sun_elevation(latitude, longitude, timestamp):
+    # Days since J2000.0
+    d = timestamp / 86400.0 - 10957.5
+    g = radians((357.529 + 0.98560028 * d) % 360)
+    q = (280.459 + 0.98564736 * d) % 360
+    ecliptic_longitude = radians((q + 1.915 * sin(g) + 0.020 * sin(2 * g)) % 360)
+    obliquity = radians(23.439 - 0.00000036 * d)
+    right_ascension = atan2(cos(obliquity) * sin(ecliptic_longitude), cos(ecliptic_longitude))
+    declination = asin(sin(obliquity) * sin(ecliptic_longitude))
+    sidereal_time = radians(((18.697374558 + 24.06570982441908 * d) % 24) * 15 + longitude)
+    hour_angle = sidereal_time - right_ascension
+    lat = radians(latitude)
+    return degrees(asin(sin(lat) * sin(declination) + cos(lat) * cos(declination) * cos(hour_angle)))
+
+
+# Table of (timestamp, color_temp, brightness) for 24 hours from 'start' with 'step' seconds resolution.
+# Target follows sun elevation: warm and dim below 'twilight' elevation, cold and bright at the day's highest sun.
+def daily_table(latitude, longitude, start, step, color_temp_cold, color_temp_warm, brightness_max, brightness_min,
+                twilight=-6.0):
+    timestamps = [start + i * step for i in range(int(86400 // step) + 1)]
+    elevations = [sun_elevation(latitude, longitude, t) for t in timestamps]
+    peak = max(max(elevations), twilight + 1.0)
+    table = []
+    for t, elevation in zip(timestamps, elevations):
+        level = min(1.0, max(0.0, (elevation - twilight) / (peak - twilight)))
+        table.append((t,
+                      int(round(color_temp_warm + (color_temp_cold - color_temp_warm) * level)),
+                      int(round(brightness_min + (brightness_max - brightness_min) * level))))
+    return table
+
+
+# Reduce table to points, where target moved past delta from the last emitted point
+def change_points(table, color_temp_delta, brightness_delta):
+    points = table[:1]
+    for t, color_temp, brightness in table[1:]:
+        _, last_color_temp, last_brightness = points[-1]
+        if abs(color_temp - last_color_temp) >= color_temp_delta or abs(brightness - last_brightness) >= brightness_delta:
+            points.append((t, color_temp, brightness))
+    return points
@@ -6,7 +6,14 @@ For more info read README.md
 """
 import appdaemon.plugins.hass.hassapi as hass
 import appdaemon.plugins.mqtt.mqttapi as mqtt
+from array import array
+import asyncio
+import datetime
 import json
+import lightmetrics
+import mqttrouter
+from lightmetrics import TRACE_DECISION
+import os
 import time
 
 # Constant
@@ -17,6 +24,7 @@ COLD = 'COLD'
 MOTION_DIMMED = 'MOTION_DIMMED'
 WARM = 'WARM'
 DIMM = 'DIMM'
+CIRCADIAN = 'CIRCADIAN'
 UNDEFINED = 'UNDEFINED'
 # Light
 BRIGHTNESS = 'brightness'
@@ -25,129 +33,580 @@ COLOR_TEMP = 'color_temp'
 SINGLE = 'single'
 HOLD = 'hold'
 DOUBLE = 'double'
+# Switch profiles: type -> {button role: (default 'action' value, handler)}.
+# Action value of a role can be overridden in switch config, e.g. 'single: left_single'.
+# Custom profiles can be defined via 'switch_profiles' config option.
+SWITCH_PROFILES = {
+    'aqara': {
+        SINGLE: (SINGLE, 'toggle'),
+        DOUBLE: (DOUBLE, 'cycle'),
+        HOLD: (HOLD, 'dimm'),
+    },
+    # Philips Hue Dimmer Switch
+    'philips': {
+        'on': ('on_press_release', 'toggle'),
+        'off': ('off_press_release', 'cycle'),
+        'on_hold': ('on_hold', 'dimm'),
+        'off_hold': ('off_hold', 'dimm'),
+    },
+    # Philips Hue Dimmer Switch with 'on' button bound directly to the light
+    'philips_bind': {
+        'off': ('off_press_release', 'cycle'),
+        'on_hold': ('on_hold', 'dimm'),
+        'off_hold': ('off_hold', 'dimm'),
+    },
+    # IKEA TRADFRI on/off switch
+    'ikea': {
+        'on': ('on', 'turn_on'),
+        'off': ('off', 'turn_off'),
+        'up_hold': ('brightness_move_up', 'cycle'),
+        'down_hold': ('brightness_move_down', 'dimm'),
+    },
+    # IKEA TRADFRI remote control
+    'ikea_remote': {
+        'toggle': ('toggle', 'toggle'),
+        'up': ('brightness_up_click', 'cycle'),
+        'down': ('brightness_down_click', 'dimm'),
+        'left': ('arrow_left_click', 'cycle'),
+        'right': ('arrow_right_click', 'cycle'),
+    },
+    # Tuya scene switches
+    'tuya': {
+        SINGLE: ('single', 'toggle'),
+        DOUBLE: ('double', 'cycle'),
+        HOLD: ('hold', 'dimm'),
+    },
+}
+# Switch handler -> LightController method name
+SWITCH_HANDLERS = {
+    'toggle': 'toggle_light',
+    'cycle': 'cycle_scene',
+    'dimm': 'select_dimm_scene',
+    'turn_on': 'turn_on_default_scene',
+    'turn_off': 'turn_off_light',
+}
+# Controller state as shown in HA
+HA_STATE_NAMES = {
+    DIMM: 'Dimm',
+    MOTION_DIMMED: 'MotD',
+    ON: 'On',
+    OFF: 'Off',
+    WARM: 'Warm',
+    COLD: 'Cold',
+    CIRCADIAN: 'Circ',
+    UNDEFINED: 'On',
+}
 # Sun
 BELOW_HORIZON = 'below_horizon'
 ABOVE_HORIZON = 'above_horizon'
+# Motion timer phases (MOTION_DIMMED is used as well)
+TIMEOUT = 'TIMEOUT'
+
+# Bulk snapshot of all HA states, shared by instances initialized at the same time
+_state_snapshot = {'time': 0, 'states': dict()}
+# State handed over from terminated instance to the new one, when app is re-initialized due to config change.
+# App name -> state (see handover_state). State of app, that is not re-initialized within its 'state_max_age'
+# (removed from config), is dropped.
+_handover = dict()
+# Immutable config objects shared by all instances: (class, fields) -> object (see 'interned')
+_interned = dict()
+# Frozen config values shared by all instances (see 'freeze')
+_frozen = dict()
+# Scene indexes with circadian targets, shared by instances with the same scene table and target
+_circadian_indexes = dict()
+# Default time window of COLD scene
+COLD_SCENE_TIME = {'start': "06:50:00", 'end': "19:00:00"}
+
+
+# Get shared instance of immutable config object with given fields. Instances with the same config
+# (hundreds of lights with default scenes) share the object, instead of each keeping its own copy.
+def interned(cls, *fields):
+    key = (cls,) + fields
+    obj = _interned.get(key)
+    if obj is None:
+        obj = _interned.setdefault(key, cls(*fields))
+    return obj
+
+
+# Immutable (and hashable) copy of config value - dicts become sorted tuples of (key, value), lists become tuples.
+# Identical values are shared by all instances.
+def freeze(value):
+    if isinstance(value, dict):
+        value = tuple(sorted(((key, freeze(v)) for key, v in value.items()), key=lambda item: str(item[0])))
+    elif isinstance(value, (list, tuple)):
+        value = tuple(freeze(v) for v in value)
+    else:
+        return value
+    return _frozen.setdefault(value, value)
+
+
+class Frozen:
+    """
+    Base of immutable config objects. Fields are set once in constructor, objects are shared via 'interned'.
+    """
+    __slots__ = ()
+    fields = ()  # fields shown in repr
+
+    def __init__(self, **values):
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % type(self).__name__)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (name, getattr(self, name))
+                                                          for name in self.fields))
+
+
+class Scene(Frozen):
+    """
+    Light scene. z2m payload of the scene is serialized once per transition and shared by all instances.
+    Color temperature is None, if the light doesn't support it.
+    """
+    __slots__ = ('state', 'brightness', 'color_temp', 'payloads')
+    fields = ('state', 'brightness', 'color_temp')
+
+    def __init__(self, state, brightness=None, color_temp=None):
+        super().__init__(state=state, brightness=brightness, color_temp=color_temp, payloads=dict())
+
+    # Command arguments for given transition
+    def command(self, transition):
+        command = dict(transition=transition)
+        if self.color_temp is not None:
+            command[COLOR_TEMP] = self.color_temp
+        if self.brightness is not None:
+            command[BRIGHTNESS] = self.brightness
+        return command
+
+    # z2m payload for given transition
+    def payload(self, transition):
+        payload = self.payloads.get(transition)
+        if payload is None:
+            payload = self.payloads[transition] = json.dumps(dict(self.command(transition), state=self.state))
+        return payload
+
+
+class SceneTable(Frozen):
+    """
+    Scenes of a controller with index of their signatures used for state detection:
+    (brightness, color_temp) -> scene. Tolerances are unrolled into the index, so state detection
+    is a single dict lookup.
+    """
+    __slots__ = ('cold', 'warm', 'dimm', 'motion_dimmed', 'brightness_tolerance', 'color_temp_tolerance',
+                 'by_name', 'index')
+    fields = ('cold', 'warm', 'dimm', 'motion_dimmed', 'brightness_tolerance', 'color_temp_tolerance')
+
+    def __init__(self, cold, warm, dimm, motion_dimmed, brightness_tolerance, color_temp_tolerance):
+        # Scenes in reversed priority order, so in case of overlapping signatures COLD wins over WARM
+        # and WARM over DIMM
+        index = self.add_signatures(dict(), ((DIMM, dimm), (WARM, warm), (COLD, cold)),
+                                    brightness_tolerance, color_temp_tolerance)
+        by_name = {OFF: interned(Scene, OFF), ON: interned(Scene, ON), MOTION_DIMMED: motion_dimmed,
+                   COLD: cold, WARM: warm, DIMM: dimm}
+        super().__init__(cold=cold, warm=warm, dimm=dimm, motion_dimmed=motion_dimmed,
+                         brightness_tolerance=brightness_tolerance, color_temp_tolerance=color_temp_tolerance,
+                         by_name=by_name, index=index)
+
+    # Add signatures of given (name, Scene) to index. Later scenes win in case of overlapping signatures.
+    @staticmethod
+    def add_signatures(index, scenes, brightness_tolerance, color_temp_tolerance):
+        for name, scene in scenes:
+            for b in range(scene.brightness - brightness_tolerance, scene.brightness + brightness_tolerance + 1):
+                if scene.color_temp is None:
+                    index[(b, None)] = name
+                    continue
+                for c in range(scene.color_temp - color_temp_tolerance,
+                               scene.color_temp + color_temp_tolerance + 1):
+                    index[(b, c)] = name
+        return index
+
+
+class MotionSensor(Frozen):
+    """
+    Motion sensor or occupancy zone config.
+    """
+    __slots__ = ('name', 'type', 'turn_on', 'true_value', 'field')
+    fields = __slots__
+
+    def __init__(self, name, type, turn_on, true_value, field):
+        super().__init__(name=name, type=type, turn_on=turn_on, true_value=true_value, field=field)
+
+
+class Switch(Frozen):
+    """
+    Switch config with resolved actions: tuple of (action value, handler name). Actions are compiled
+    into single action -> LightController method name table, so click costs one dict lookup.
+    """
+    __slots__ = ('name', 'type', 'actions', 'handlers')
+    fields = ('name', 'type', 'actions')
+
+    def __init__(self, name, type, actions):
+        for action, handler in actions:
+            if handler not in SWITCH_HANDLERS:
+                raise Exception("Unknown switch handler {}".format(handler))
+        super().__init__(name=name, type=type, actions=actions,
+                         handlers={action: SWITCH_HANDLERS[handler] for action, handler in actions})
+
+
+class MotionTimer:
+    """
+    Motion timer owned by the controller. Phase, start time and deadline are tracked locally,
+    so checking timer status needs no AppDaemon call.
+    Stopping and starting timer again does not cancel scheduler callback - if it fires before the deadline,
+    it re-arms itself for the remaining time. So noisy motion sensor produces at most one scheduler callback
+    per timeout period.
+    """
+
+    def __init__(self, app, callback):
+        self.app = app
+        self.callback = callback  # called as callback(phase) on deadline
+        self.phase = None  # None when stopped, otherwise TIMEOUT or MOTION_DIMMED
+        self.started = 0
+        self.deadline = 0
+        self.handle = None  # AppDaemon timer handle
+        self.handle_time = 0  # time, when AppDaemon timer fires
+
+    @property
+    def running(self):
+        return self.phase is not None
+
+    def start(self, phase, duration):
+        lightmetrics.count('timer_restarts')
+        now = time.time()
+        self.phase = phase
+        self.started = now
+        self.deadline = now + duration
+        # Scheduler callback firing before the deadline is reused, as it re-arms itself
+        if self.handle is not None and self.handle_time > self.deadline:
+            self.app.cancel_timer(self.handle)
+            self.handle = None
+        if self.handle is None:
+            self.schedule(duration)
+
+    def stop(self):
+        # Scheduler callback is kept - it will be ignored or reused by next start
+        self.phase = None
+
+    def schedule(self, delay):
+        lightmetrics.count('timer_schedules')
+        self.handle_time = time.time() + delay
+        self.handle = self.app.run_in(self.on_scheduler, delay)
+
+    def on_scheduler(self, kwargs):
+        self.handle = None
+        if self.phase is None:
+            return
+        remaining = self.deadline - time.time()
+        if remaining > 0:
+            # Deadline was pushed forward in the meantime
+            self.schedule(remaining)
+            return
+        phase = self.phase
+        self.phase = None
+        self.callback(phase)
+
+
+class AsyncMotionTimer(MotionTimer):
+    """
+    Motion timer with scheduler callback running in AppDaemon event loop.
+    """
+
+    async def on_scheduler(self, kwargs):
+        super().on_scheduler(kwargs)
+
+
+# Time spent by work in low priority lane
+lane_low_wait = lightmetrics.METRICS.histogram('lane_low_wait', 'lane_wait', ('lane', 'low'))
+
+
+class LowLane:
+    """
+    Low priority lane of controller work - state echoes, sensor reports and HA state writes.
+    Same as command debounce, the first work of a burst runs right away and the rest within 'delay' is queued
+    by key. Newer work replaces queued one with the same key and moves behind the rest, so the burst is processed
+    once, from single scheduler callback at the end of the window. High priority work (human initiated actions)
+    never goes through the lane and doesn't wait for the queued work. Stale light reports processed after its command
+    are handled as any other late report (see 'expect_state').
+    Without 'delay' (None) all work runs right away.
+    """
+
+    def __init__(self, app, delay):
+        self.app = app
+        self.delay = delay
+        self.queue = dict()  # key -> (callback, args, time of first enqueue)
+        self.timer = None
+        self.last_run = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def push(self, key, callback, *args):
+        if self.delay is None:
+            callback(*args)
+            return
+        now = time.time()
+        if not self.queue and self.timer is None and now - self.last_run >= self.delay:
+            self.last_run = now
+            callback(*args)
+            return
+        entry = self.queue.pop(key, None)
+        if entry is None:
+            lightmetrics.gauge('lane_low_depth', 1)
+            queued = time.perf_counter()
+        else:
+            lightmetrics.count('lane_low_coalesced')
+            queued = entry[2]
+        self.queue[key] = (callback, args, queued)
+        if self.timer is None:
+            self.timer = self.app.run_in(self.on_scheduler, max(0, self.last_run + self.delay - now))
+
+    def drain(self):
+        queue = self.queue
+        if queue:
+            self.last_run = time.time()
+        while queue:
+            callback, args, queued = queue.pop(next(iter(queue)))
+            lightmetrics.gauge('lane_low_depth', -1)
+            lane_low_wait.observe(time.perf_counter() - queued)
+            callback(*args)
+
+    def on_scheduler(self, kwargs):
+        self.timer = None
+        self.drain()
+
+
+class AsyncLowLane(LowLane):
+    """
+    Low priority lane with scheduler callback running in AppDaemon event loop.
+    """
+
+    async def on_scheduler(self, kwargs):
+        super().on_scheduler(kwargs)
 
 
 class LightController(hass.Hass, mqtt.Mqtt):
+    motion_timer_class = MotionTimer
+    low_lane_class = LowLane
+
     def initialize(self):
         """
         Load configuration.
         """
+        # Config as loaded (frozen, so it can't be changed), so the next reload can be compared with it.
+        # On reload, state of the previous instance is kept for entities, that are still configured.
+        self.config = {key: freeze(value) for key, value in self.args.items()}
+        self.expire_handovers()
+        self.handover = _handover.pop(self.name, None)
+        # Topics of the previous instance, those not listened to anymore are released at the end
+        z2m_previous = self.handover['z2m_subscribed'] if self.handover is not None else set()
+        if self.handover is not None:
+            if time.time() - self.handover['time'] > self.args.get('state_max_age', 600):
+                self.handover = None
+            else:
+                changed = sorted(key for key in set(self.config) | set(self.handover['args'])
+                                 if self.config.get(key) != self.handover['args'].get(key))
+                self.log('Config reloaded, changed: %s' % ', '.join(changed))
+
         # Supported function
         self.color_temp_support = self.args.get('color_temp_support', True)
         self.auto_color_temp_change = self.args.get('auto_color_temp_change', True)
 
-        # Control entities
-        self.light_entity = self.args['light_entity']
-        self.mqtt_entity = self.args.get('mqtt_entity', None)
-
-        # Scenes
-        self.scene_cold = self.args.get('scene_cold', dict())
-        self.scene_warm = self.args.get('scene_warm', dict())
-        self.scene_dimm = self.args.get('scene_dimm', dict())
-
-        # Get brightness for scenes
-        self.scene_cold[BRIGHTNESS] = self.scene_cold.get(BRIGHTNESS, 255)
-        self.scene_warm[BRIGHTNESS] = self.scene_warm.get(BRIGHTNESS, 255)
-        self.scene_dimm[BRIGHTNESS] = self.scene_dimm.get(BRIGHTNESS, 76)
-
-        # Get color temp for scenes (if supported)
-        if self.color_temp_support:
-            self.scene_cold[COLOR_TEMP] = self.scene_cold.get(COLOR_TEMP, 250)
-            self.scene_warm[COLOR_TEMP] = self.scene_warm.get(COLOR_TEMP, 389)
-            self.scene_dimm[COLOR_TEMP] = self.scene_dimm.get(COLOR_TEMP, 400)
+        # Control entities. In multi-light mode single instance controls all lights of a room as one light.
+        self.light_entities = self.args.get('light_entities') or [self.args['light_entity']]
+        self.light_entity = self.light_entities[0]
+        self.mqtt_entities = self.args.get('mqtt_entities') or (
+            [self.args['mqtt_entity']] if self.args.get('mqtt_entity') else [])
+        if self.mqtt_entities and len(self.mqtt_entities) != len(self.light_entities):
+            raise Exception("mqtt_entities must be defined for all light_entities")
+        # z2m topic, that receives commands - single light or z2m group of all lights.
+        # Without it, commands in multi-light mode are sent to each light.
+        self.mqtt_entity = self.args.get('mqtt_group') or (
+            self.mqtt_entities[0] if len(self.mqtt_entities) == 1 else None)
+        self.event_names = {'all', *self.light_entities, *self.mqtt_entities}
+        if self.mqtt_entity:
+            self.event_names.add(self.mqtt_entity)
+        # Reported state of each light: brightness (0 - off, -1 - unknown) and color temperature (-1 - unknown)
+        self.light_brightness = array('h', [-1] * len(self.light_entities))
+        self.light_color_temp = array('h', [-1] * len(self.light_entities))
+
+        # Scenes. Scene tables are immutable and shared by all instances with the same scenes.
+        self.brightness_tolerance = self.args.get('brightness_tolerance', 1)
+        self.color_temp_tolerance = self.args.get('color_temp_tolerance', 0)
+        self.brightness_dimmed_light = self.args.get('brightness_dimmed_light', 8)
+        self.scenes = interned(SceneTable,
+                               self.config_scene('scene_cold', 255, 250),
+                               self.config_scene('scene_warm', 255, 389),
+                               self.config_scene('scene_dimm', 76, 400),
+                               # For MOTION_DIMMED change brightness only, as it will preserve color temperature,
+                               # that we don't want to change.
+                               interned(Scene, ON, self.brightness_dimmed_light),
+                               self.brightness_tolerance, self.color_temp_tolerance)
+
+        # Circadian scene - color temperature and brightness following the sun, target is provided by the coordinator
+        self.circadian = self.args.get('circadian', False)
+        self.scene_circadian = None
+        self.scene_circadian_previous = None
+        self.circadian_applied = None  # circadian target, that was sent to the light last time
+
+        # Scene signatures used for state detection
+        self.scene_index = self.build_scene_index()
+
+        # Trace of processed events. Records are formatted only when dumped via 'lightctrl.trace' event,
+        # or logged right away, if their level is within 'trace_level' (0 - none, 1 - decisions, 2 - all events).
+        self.trace = lightmetrics.Trace(self.args.get('trace_size', 100), self.args.get('trace_level', 1), self.log)
+        if self.handover is not None:
+            self.trace.records.extend(self.handover['trace'])
 
         # Config print
-        self.log('Config for %s' % self.light_entity)
-        self.log('scene_cold: %s' % str(self.scene_cold))
-        self.log('scene_warm: %s' % str(self.scene_warm))
-        self.log('scene_dimm: %s' % str(self.scene_dimm))
+        self.log('Config for %s' % ', '.join(self.light_entities))
+        self.log('scene_cold: %s' % str(self.scenes.cold))
+        self.log('scene_warm: %s' % str(self.scenes.warm))
+        self.log('scene_dimm: %s' % str(self.scenes.dimm))
+
+        # Shared MQTT router. If defined, every z2m topic is subscribed and decoded only once for all instances.
+        self.router = None
+        if self.args.get('mqtt_router'):
+            self.router = self.get_app(self.args['mqtt_router'])
+            if self.router is None:
+                raise Exception("MQTT router app {} not found".format(self.args['mqtt_router']))
+        # Topics this app listens to without router (subscriptions are kept by AppDaemon over config reload)
+        self.z2m_subscribed = set()
+        # z2m output type: 'json' - whole device state on 'zigbee2mqtt/<name>' topic,
+        # 'attribute' - only watched attributes are subscribed as 'zigbee2mqtt/<name>/<attribute>' topics
+        self.z2m_output = self.args.get('z2m_output', 'json')
+        if self.z2m_output not in ('json', 'attribute'):
+            raise Exception("Unknown z2m_output {}".format(self.z2m_output))
+
+        # Coordinator of all lights. If defined, it handles 'lightctrl.set' event and time based scene changes.
+        self.coordinator = None
+        if self.args.get('coordinator'):
+            self.coordinator = self.get_app(self.args['coordinator'])
+            if self.coordinator is None:
+                raise Exception("Coordinator app {} not found".format(self.args['coordinator']))
+        if self.circadian and self.coordinator is None:
+            raise Exception("circadian requires coordinator to be defined")
 
         # Command debounce
         self.debounce = self.args.get('debounce', 1.0)  # debounce time in seconds
         self.last_command = 0  # indicates last switch action timestamp
+        self.last_sent_command = None  # (scene, transition) of last command sent to the light
+        # Command requested within debounce window. Only the last one is sent at the end of the window.
+        self.pending_command = None
+        self.pending_command_timer = None
+
+        # Priority lanes. Light state echoes, sensor reports and HA state writes are coalesced in low priority lane,
+        # so switch clicks and HA events are not queued behind their bursts.
+        self.low_lane = self.low_lane_class(
+            self, self.args.get('low_lane_delay', 0.1) if self.args.get('priority_lanes', False) else None)
 
         # Switches
+        self.switch_profiles = SWITCH_PROFILES
+        if self.args.get('switch_profiles'):
+            self.switch_profiles = dict(SWITCH_PROFILES)
+            for name, roles in self.args['switch_profiles'].items():
+                self.switch_profiles[name] = {role: (cfg['action'], cfg['handler']) for role, cfg in roles.items()}
         self.log("Defined switches:")
         self.switches = dict()
-        for switch in self.args['switches']:
-            # Subscribe to topic to receive messages
-            self.mqtt_subscribe("zigbee2mqtt/%s" % switch['name'], namespace='mqtt')
-            # Listen to events related to given switch
-            self.listen_event(self.on_click, "MQTT_MESSAGE", namespace='mqtt', topic="zigbee2mqtt/%s" % switch['name'],
-                              switch=switch['name'])
-            # Process remaining config options
-            switch['type'] = switch.get('type', 'aqara')
-            if switch['type'] == 'aqara':
-                switch[SINGLE] = switch.get(SINGLE, SINGLE)
-                switch[HOLD] = switch.get(HOLD, HOLD)
-                switch[DOUBLE] = switch.get(DOUBLE, DOUBLE)
-            elif switch['type'] in ['philips', 'philips_bind']:
-                pass
-            else:
-                raise Exception("Unknown switch type {}".format(switch['type']))
+        for config in self.args['switches']:
+            switch = self.compile_switch(config)
+            # Listen to messages related to given switch
+            self.listen_z2m(switch.name, self.on_click, ('action',), switch=switch)
 
             # Save switch config
-            self.switches[switch['name']] = switch
+            self.switches[switch.name] = switch
             # Log switch configuration
-            self.log('Input: %s' % switch)
+            self.log('Input: %s' % str(switch))
 
         # Configure time based scene selector. Used in addition to sun based processing.
         self.cold_scene_time = self.args.get("cold_scene_time", None)
         if self.cold_scene_time == 'disabled':
             self.cold_scene_time = None
         else:
-            self.cold_scene_time = {
-                'start': "06:50:00",
-                'end': "19:00:00"
-            }
-        if self.cold_scene_time is not None:
-            self.run_daily(self.on_time, self.cold_scene_time['start'], random_start=5, random_end=10)
-            self.run_daily(self.on_time, self.cold_scene_time['end'], random_start=5, random_end=10)
+            self.cold_scene_time = COLD_SCENE_TIME
 
         # For dimm scene, we don't want to have default behavior
         if self.args.get("warm_scene_time"):
             self.warm_scene_time = self.args['warm_scene_time']
-            self.run_daily(self.on_time, self.warm_scene_time['start'], random_start=5, random_end=10)
-            self.run_daily(self.on_time, self.warm_scene_time['end'], random_start=5, random_end=10)
         else:
             self.warm_scene_time = None
 
+        # With coordinator, time boundaries are scheduled once for all lights and changes are rolled out with rate limit
+        self.auto_color_temp_change_transition = self.args.get('auto_color_temp_change_transition', 30)
+        if self.coordinator is None:
+            for boundary in self.scene_time_boundaries():
+                self.run_daily(self.on_time, boundary, random_start=5, random_end=10)
+
         # Motion sensors
         self.motion_sensors = {}
+        self.active_motion_sensors = 0  # number of sensors with motion detected (any value other than False)
         self.ignore_motion_after_turn_off_time = self.args.get('ignore_motion_after_turn_off_time', 5)
         self.last_turn_off_due_to_switch = 0
-        if self.args.get('motion_sensors'):
+        self.occupancy_zones = None
+        if self.args.get('motion_sensors') or self.args.get('motion_zones'):
             self.log('Adding motions sensors')
             self.motion_timeout = self.args.get("motion_timeout", 5 * 60)
             self.log('Motion timeout %d' % self.motion_timeout)
-            for sensor in self.args['motion_sensors']:
-                sensor['turn_on'] = sensor.get('turn_on', True)
-                sensor['type'] = sensor.get('type', 'mqtt')
-                sensor['true_value'] = sensor.get('true_value', None)
-                self.motion_sensors[sensor['name']] = False  # Assume some initial condition - no motion
-                if sensor['type'] == 'mqtt':
-                    self.mqtt_subscribe("zigbee2mqtt/%s" % sensor['name'], namespace='mqtt')
-                    self.listen_event(self.occupancy_mqtt_callback, "MQTT_MESSAGE", namespace='mqtt',
-                                      topic="zigbee2mqtt/%s" % sensor['name'],
-                                      motion_sensor=sensor)
+            for config in self.args.get('motion_sensors', []):
+                sensor = interned(MotionSensor, config['name'], config.get('type', 'mqtt'),
+                                  config.get('turn_on', True), config.get('true_value', None),
+                                  config.get('monitored_field', 'occupancy'))
+                self.motion_sensors[sensor.name] = False  # Assume some initial condition - no motion
+                if sensor.type == 'mqtt':
+                    self.listen_z2m(sensor.name, self.occupancy_mqtt_callback, (sensor.field,), motion_sensor=sensor)
                 else:
-                    self.listen_state(self.occupancy_ha_callback, sensor['name'], motion_sensor=sensor)
+                    self.listen_state(self.occupancy_ha_callback, sensor.name, motion_sensor=sensor)
                 self.log('Input %s' % str(sensor))
+            # Zones of shared occupancy service. Each zone is handled as a single motion sensor.
+            if self.args.get('motion_zones'):
+                zones_app = self.args.get('occupancy_zones', 'occupancy_zones')
+                self.occupancy_zones = self.get_app(zones_app)
+                if self.occupancy_zones is None:
+                    raise Exception("Occupancy zones app {} not found".format(zones_app))
+            for config in self.args.get('motion_zones', []):
+                zone = interned(MotionSensor, config['name'], 'zone', config.get('turn_on', True), None, None)
+                occupied = self.occupancy_zones.subscribe(self, zone.name, self.on_zone, motion_sensor=zone)
+                self.motion_sensors[zone.name] = occupied
+                self.active_motion_sensors += occupied
+                self.log('Input zone %s' % str(zone))
         else:
             self.motion_sensors = None
-        self.timer = None
+        self.motion_timer = self.motion_timer_class(self, self.on_timer)
+        # Controller state persisted in 'state_dir', so motion processing continues after AppDaemon restart
+        self.state_dir = self.args.get('state_dir', None)
+        if self.state_dir:
+            try:
+                os.makedirs(self.state_dir, exist_ok=True)
+            except OSError as e:
+                self.log('Unable to create state directory %s: %s' % (self.state_dir, e), level='WARNING')
+        self.state_max_age = self.args.get('state_max_age', 600)
+        self.saved_state = None  # last written state (json without time)
+        self.saved_state_time = 0
+        restored = False
+        if self.handover is not None:
+            restored = self.restore_state(self.handover)
+        elif self.state_dir:
+            saved = self.load_state()
+            restored = saved is not None and self.restore_state(saved)
         self.power_off_cancel_timeout = self.args.get('power_off_cancel_timeout', 8)
         self.motion_power_off_transition_time = self.args.get('motion_power_off_transition_time', 5)
-        self.brightness_dimmed_light = self.args.get('brightness_dimmed_light', 8)
+        self.motion_dimmed_brightness_range = range(self.brightness_dimmed_light - self.brightness_tolerance,
+                                                    self.brightness_dimmed_light + self.brightness_tolerance + 1)
 
+        # Conditions of motion turn on feature. Values of used entities are cached locally and kept fresh
+        # via state listeners, so motion processing needs no state lookup.
+        self.condition_values = dict()  # (entity, attribute) -> value
+        conditions = list(self.args.get('turn_on_conditions', []))
         self.turn_on_light_enable_entity = self.args.get('turn_on_light_enable_entity', None)
         self.turn_on_light_enable_true_value = self.args.get('turn_on_light_enable_true_value', None)
         if self.turn_on_light_enable_entity is not None:
             self.log("Motion turn on feature is controlled by {} entity with '{}' value".format(
                 str(self.turn_on_light_enable_entity), str(self.turn_on_light_enable_true_value)))
+            conditions.append({'entity': self.turn_on_light_enable_entity,
+                               'value': self.turn_on_light_enable_true_value})
+        self.turn_on_condition = self.compile_condition({'all': conditions}) if conditions else None
+        if conditions:
+            self.log('Motion turn on conditions: %s' % str(conditions))
 
         # Contacts
         self.contacts = {}
@@ -155,136 +614,405 @@ class LightController(hass.Hass, mqtt.Mqtt):
             self.log("Adding contacts")
             for contact in self.args['contacts']:
                 self.contacts[contact['name']] = None  # undefined
-                self.mqtt_subscribe("zigbee2mqtt/%s" % contact['name'], namespace='mqtt')
-                self.listen_event(self.on_contact, "MQTT_MESSAGE", namespace='mqtt',
-                                  topic="zigbee2mqtt/%s" % contact['name'],
-                                  contact=contact)
+                if self.handover is not None:
+                    self.contacts[contact['name']] = self.handover['contacts'].get(contact['name'])
+                self.listen_z2m(contact['name'], self.on_contact, ('contact',), contact=contact['name'])
                 self.log('Input %s' % str(contact))
         else:
             self.contacts = None
 
+        # Mirror of controller state in HA light entity attributes. Only changes are written,
+        # bursts within 'ha_state_delay' are coalesced into single write.
+        self.ha_state_delay = self.args.get('ha_state_delay', 0.5)
+        self.ha_state_diagnostics = self.args.get('ha_state_diagnostics', False)
+        self.ha_state_known = {entity: dict() for entity in self.light_entities}  # attributes, as last seen in HA
+        if self.handover is not None:
+            self.ha_state_known.update((entity, attributes) for entity, attributes
+                                       in self.handover['ha_state_known'].items() if entity in self.ha_state_known)
+        self.ha_state_timer = None
+        self.last_trigger = None  # source of the last processed input
+
+        # Read light state directly from z2m. HA state is used only until first z2m report is received.
+        self.mqtt_state = self.args.get('mqtt_state', False)
+        self.mqtt_state_received = False
+
         # Listen state of light
         # State of light is buffered to speed up execution time
-        self.listen_state(self.on_light, self.light_entity, attribute='all')
+        for i, entity in enumerate(self.light_entities):
+            self.listen_state(self.on_light, entity, attribute='all', light=i)
         self.current_state = ''
-        self.current_state = self.detect_state()
-        self.set_ha_state()
+        # State expected after last command. Until it is confirmed (or deadline passes),
+        # reports different from it are treated as stale or transitional ones.
+        self.expected_state = None
+        self.expected_state_deadline = 0
+        self.expected_state_timer = None
+        self.state_confirm_timeout = self.args.get('state_confirm_timeout', 3)
+        if self.handover is not None and self.handover['light_entities'] == self.light_entities:
+            # Lights are the same, so there is no need to query them again. Scene tables might have changed,
+            # so the state is classified again.
+            self.light_brightness = self.handover['light_brightness']
+            self.light_color_temp = self.handover['light_color_temp']
+            self.mqtt_state_received = self.handover['mqtt_state_received']
+            self.current_state = self.classify_room()
+            self.reported_state = self.current_state
+            if self.handover['expected_state'] is not None:
+                self.expect_state(self.handover['expected_state'],
+                                  max(0, self.handover['expected_state_deadline'] - time.time()
+                                      - self.state_confirm_timeout))
+        else:
+            self.current_state = self.detect_state()
+            self.reported_state = self.current_state  # last state reported by the light
+        if self.mqtt_state:
+            if not self.mqtt_entities:
+                raise Exception("mqtt_state requires mqtt_entity to be defined")
+            for i, entity in enumerate(self.mqtt_entities):
+                # State, brightness and color temperature are needed together, so whole device state is used
+                self.listen_z2m(entity, self.on_light_mqtt, ('state',), output='json', light=i)
 
         # Select default scene
         self.default_scene = None
         self.process_default_scene()
+        self.set_ha_state()
 
-        # Subscribe to HA event
-        self.listen_event(self.on_ha_event, event="lightctrl.set")
+        # Subscribe to HA event. If coordinator is defined, it processes the event once for all lights.
+        if self.coordinator is not None:
+            self.coordinator.register(self)
+        else:
+            self.listen_event(self.on_ha_event, event="lightctrl.set")
+        self.listen_event(self.on_trace_event, event="lightctrl.trace")
 
         # Process 'MQTT' custom events
         if self.args.get('events'):
             self.log("Adding MQTT events")
             for event_data in self.args['events']:
                 self.log('Event data: %s' % str(event_data))
-                self.mqtt_subscribe("zigbee2mqtt/%s" % event_data['name'], namespace='mqtt')
-                self.listen_event(self.on_mqtt_event, "MQTT_MESSAGE", namespace='mqtt',
-                                  topic="zigbee2mqtt/%s" % event_data['name'],
-                                  event_data=event_data)
+                self.listen_z2m(event_data['name'], self.on_mqtt_event, (event_data['field'],), event_data=event_data)
+
+        if self.handover is not None and self.handover['pending_command'] is not None:
+            # Command requested within debounce window just before reload
+            self.last_sent_command = self.handover['last_sent_command']
+            self.pending_command = self.handover['pending_command']
+            self.pending_command_timer = self.run_in(self.on_pending_command,
+                                                     max(0, self.debounce - (time.time() - self.last_command)))
+        self.handover = None
+        # Devices removed from config
+        self.release_z2m_topics(self.name, z2m_previous - self.z2m_subscribed)
+
+        if restored:
+            # Resume motion processing, e.g. timer for light left on, when there is no motion
+            self.process_light_timeout()
+        if self.state_dir:
+            interval = self.args.get('state_save_interval', 60)
+            self.run_every(self.on_save_state, "now+%d" % interval, interval)
+
+    def terminate(self):
+        self.low_lane.drain()
+        # Keep state for the new instance, if the app is re-initialized due to config change
+        self.expire_handovers()
+        _handover[self.name] = self.handover_state()
+        # Handlers registered in the router are not removed by AppDaemon, as they belong to other app.
+        # Topics are kept subscribed for a while, so the new instance doesn't need to subscribe them again.
+        if self.router is not None:
+            self.router.unregister(self, linger=True)
+        if self.coordinator is not None:
+            self.coordinator.unregister(self)
+        if self.occupancy_zones is not None:
+            self.occupancy_zones.unsubscribe(self)
+        if self.state_dir:
+            self.save_state(force=True)
+
+    # Drop state handed over by apps, that were not re-initialized in time (removed from config),
+    # together with their z2m topics
+    def expire_handovers(self):
+        now = time.time()
+        for name, state in list(_handover.items()):
+            if now - state['time'] > state['args'].get('state_max_age', 600) and _handover.pop(name, None):
+                self.release_z2m_topics(name, state['z2m_subscribed'])
+
+    # Stop listening to z2m topics (without router) on behalf of given app. Topic is unsubscribed,
+    # when no other app uses it (see mqttrouter.subscribe_topic).
+    def release_z2m_topics(self, name, topics):
+        for topic in topics:
+            mqttrouter.unsubscribe_topic(self, topic, name)
+
+    # Get full state of entity from bulk snapshot of all HA states. Snapshot is taken once
+    # and shared by all instances, that are initialized within 'state_snapshot_max_age'. With 'consume',
+    # the state is taken out of the snapshot - light state changes by the first command, so instance
+    # re-initialized in the meantime queries it again.
+    def get_snapshot_state(self, entity, consume=False):
+        now = time.time()
+        max_age = self.args.get('state_snapshot_max_age', 5)
+        if now - _state_snapshot['time'] > max_age:
+            lightmetrics.count('get_state_calls')
+            _state_snapshot['states'] = self.get_state() or dict()
+            _state_snapshot['time'] = now
+            # Dump of all HA entities is not kept in memory after the startup window
+            self.run_in(self.on_state_snapshot_expired, max_age, taken=now)
+        states = _state_snapshot['states']
+        state = states.pop(entity, None) if consume else states.get(entity)
+        if state is None:
+            # Entity created after the snapshot
+            lightmetrics.count('get_state_calls')
+            state = self.get_state(entity, attribute='all')
+        return state
+
+    def on_state_snapshot_expired(self, kwargs):
+        if _state_snapshot['time'] == kwargs['taken']:
+            _state_snapshot['states'] = dict()
+
+    def state_file(self):
+        return os.path.join(self.state_dir, '%s.json' % self.name)
+
+    # Load state persisted before restart. Returns None, if there is no usable state.
+    def load_state(self):
+        try:
+            with open(self.state_file()) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - saved['time'] > self.state_max_age:
+            self.log('Persisted state ignored, as it is too old')
+            return None
+        return saved
+
+    # Restore persisted or handed over state. Returns True, if state was restored.
+    def restore_state(self, saved):
+        self.last_command = saved['last_command']
+        self.last_turn_off_due_to_switch = saved['last_turn_off_due_to_switch']
+        if self.motion_sensors is not None:
+            # Zones are kept by OccupancyZones app, so only own sensors are restored
+            for sensor in self.args.get('motion_sensors', []):
+                if sensor['name'] in saved['motion']:
+                    previous = self.motion_sensors[sensor['name']]
+                    occupancy = saved['motion'][sensor['name']]
+                    self.motion_sensors[sensor['name']] = occupancy
+                    self.active_motion_sensors += (previous is False) - (occupancy is False)
+            if saved['timer'] is not None:
+                phase, started, deadline = saved['timer']
+                # Deadline passed during restart is processed right away
+                self.motion_timer.start(phase, max(0, deadline - time.time()))
+                self.motion_timer.started = started
+        self.log('State restored: motion=%s, timer=%s' % (str(saved['motion']), str(saved['timer'])))
+        return True
+
+    # State persisted over restarts (see 'state_dir') and handed over on config reload
+    def persistent_state(self):
+        timer = self.motion_timer
+        return {
+            'motion': self.motion_sensors or dict(),
+            'timer': [timer.phase, timer.started, timer.deadline] if timer.running else None,
+            'last_command': self.last_command,
+            'last_turn_off_due_to_switch': self.last_turn_off_due_to_switch,
+        }
+
+    # State handed over to the new instance on config reload. In addition to persisted state, it keeps
+    # everything, that would need to be queried or learned again.
+    def handover_state(self):
+        state = self.persistent_state()
+        state.update({
+            'time': time.time(),
+            'args': self.config,
+            'trace': list(self.trace.records),
+            'z2m_subscribed': self.z2m_subscribed,
+            'contacts': dict(self.contacts or {}),
+            'condition_values': dict(self.condition_values),
+            'ha_state_known': self.ha_state_known,
+            'light_entities': self.light_entities,
+            'light_brightness': self.light_brightness,
+            'light_color_temp': self.light_color_temp,
+            'mqtt_state_received': self.mqtt_state_received,
+            'expected_state': self.expected_state,
+            'expected_state_deadline': self.expected_state_deadline,
+            'last_sent_command': self.last_sent_command,
+            'pending_command': self.pending_command,
+        })
+        return state
+
+    def on_save_state(self, kwargs):
+        self.save_state()
 
-    def on_mqtt_event(self, event_name, data, kwargs):
+    # Write state to file, if it changed. Unchanged state is rewritten only to keep it from getting too old.
+    def save_state(self, force=False):
+        state = json.dumps(self.persistent_state(), separators=(',', ':'))
+        now = time.time()
+        if not force and state == self.saved_state and now - self.saved_state_time < self.state_max_age / 2:
+            return
+        tmp = self.state_file() + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write('{"time":%f,%s' % (now, state[1:]))
+            os.replace(tmp, self.state_file())
+        except OSError as e:
+            # Tried again on next interval
+            self.log('Unable to save state: %s' % e, level='WARNING')
+            return
+        self.saved_state = state
+        self.saved_state_time = now
+
+    # Listen to messages from given z2m device. Callback is called as callback(payload, kwargs)
+    # with already decoded payload - via shared router (if configured) or via own subscription.
+    # Only payloads containing any of 'fields' are decoded. With 'attribute' output, topics of these fields
+    # are subscribed instead, so the rest of device state is not received at all.
+    def listen_z2m(self, name, callback, fields, output=None, **kwargs):
+        topic = "zigbee2mqtt/%s" % name
+        if (output or self.z2m_output) == 'attribute':
+            topics = [("%s/%s" % (topic, field), field) for field in fields]
+        else:
+            topics = [(topic, None)]
+        for topic, attribute in topics:
+            if self.router is not None:
+                self.router.register(self, topic, callback, fields=fields, attribute=attribute, **kwargs)
+            else:
+                if topic not in self.z2m_subscribed:
+                    mqttrouter.subscribe_topic(self, topic)
+                    self.z2m_subscribed.add(topic)
+                self.listen_event(self.on_z2m_message, "MQTT_MESSAGE", namespace='mqtt', topic=topic,
+                                  z2m_callback=callback, z2m_kwargs=kwargs, z2m_attribute=attribute,
+                                  z2m_keys=mqttrouter.payload_keys(fields))
+
+    # Decode payload, when no router is used
+    def on_z2m_message(self, event_name, data, kwargs):
+        payload = mqttrouter.decode_payload(data['payload'], kwargs['z2m_attribute'], kwargs['z2m_keys'])
+        if payload is not None:
+            kwargs['z2m_callback'](payload, kwargs['z2m_kwargs'])
+
+    def on_mqtt_event(self, payload, kwargs):
         event_data = kwargs['event_data']
-        payload = json.loads(data['payload'])
         value = payload.get(event_data['field'], None)
 
         if value == event_data['value']:
+            self.last_trigger = event_data['name']
             self.process_action(
                 action=event_data.get('action', None),
                 transition=event_data.get('transition', 0),
                 scene=event_data.get('scene', None))
-            self.log("MQTT event processed: e=%s, p=%s, v=%s" % (str(event_data), str(payload), value))
+            self.trace(event_data['name'], 'mqtt event', details=payload)
 
     # Process external events like from the HA
     def on_ha_event(self, event, data, kwargs):
-        acceptable_names = {'all', self.light_entity, self.mqtt_entity}
-        # Below, please have in mind, that mqtt_entity can be None, so default value for 'light' can't be None
-        if (data.get('light', 'NONE') in acceptable_names) or any(
-                n in data.get('lights', {}) for n in acceptable_names):
-            self.process_action(
-                action=data.get('action', None),
-                transition=data.get('transition', 0),
-                scene=data.get('scene', None))
-            self.log("HA event processed: %s" % str(data))
+        if self.is_event_target(data):
+            self.process_event(data)
+
+    # Process 'lightctrl.set' event addressed to this light
+    def process_event(self, data):
+        self.last_trigger = 'event'
+        self.process_action(
+            action=data.get('action', None),
+            transition=data.get('transition', 0),
+            scene=data.get('scene', None))
+        self.trace('event', 'ha event', details=data)
+
+    # Callback handed over from shared app (router, occupancy zones, coordinator), run in thread of this app
+    def on_handoff(self, kwargs):
+        callback, args = kwargs['handoff']
+        callback(*args)
+
+    # Dump trace on 'lightctrl.trace' event
+    def on_trace_event(self, event, data, kwargs):
+        if self.is_event_target(data):
+            self.log('Trace of last %d events:\n%s' % (len(self.trace.records), '\n'.join(self.trace.dump())))
+
+    # Check, if 'lightctrl.set' event is addressed to this light
+    def is_event_target(self, data):
+        names = self.event_names
+        return data.get('light') in names or any(n in names for n in data.get('lights', ()))
 
     def process_action(self, action, transition=0, scene=None):
+        if action == 'toggle':
+            self.toggle_light()
+            return
+        planned = self.plan_action(action, scene)
+        if planned is not None:
+            scene, force = planned
+            self.trace(self.last_trigger, action, details=scene)
+            self.select_scene(scene, transition, force=force)
+
+    # Decide, which scene should be selected for given action (except toggle).
+    # Returns (scene, force) or None, if no change is needed.
+    def plan_action(self, action, scene=None):
         if action == 'turn_on':
             if self.current_state == OFF or self.is_motion_dimm_running:
-                self.select_scene(self.default_scene, transition)
-                self.log("Turn ON the light due to event")
+                return self.default_scene, False
         elif action == 'turn_on_motion_dimmed':
             if self.is_motion_dimm_running:
-                self.select_scene(self.default_scene, transition, force=True)
-                self.log("Turn ON the light due to event during motion dimmed state")
+                return self.default_scene, True
         elif action == 'force_turn_on':
-            self.select_scene(self.default_scene, transition, force=True)
-            self.log("Force turn ON the light due to event")
+            return self.default_scene, True
         elif action == 'turn_off':
             if self.current_state != OFF:
-                self.select_scene(OFF, transition)
-                self.log("Turn OFF the light due to event")
+                return OFF, False
         elif action == 'set_scene' and scene in {OFF, WARM, COLD, DIMM}:
-            self.select_scene(scene, transition)
-            self.log("Select %s scene due to event" % scene)
-        elif action == 'toggle':
-            self.toggle_light()
+            return scene, False
+        elif action == 'set_scene' and scene == CIRCADIAN and self.scene_circadian is not None:
+            return scene, False
         else:
             raise Exception('Incorrect action %s' % action)
+        return None
 
-    def on_contact(self, event_name, data, kwargs):
-        contact = kwargs['contact']
-        contact_name = contact['name']
-        payload = json.loads(data['payload'])
+    def on_contact(self, payload, kwargs):
+        contact_name = kwargs['contact']
         contact_status = payload.get('contact', None)
 
         if contact_status is None:
             # Payload does not contain occupancy data
             return
+        # Keyed by status as well, so opening is not lost, when the contact flaps
+        self.low_lane.push(('contact', contact_name, contact_status), self.process_contact, contact_name, contact_status)
+
+    def process_contact(self, contact_name, contact_status):
         if self.contacts[contact_name] == contact_status:
             # No change
             return
         self.contacts[contact_name] = contact_status
+        self.last_trigger = contact_name
 
         # Some change occurred
         if contact_status is False and (self.current_state == OFF or self.is_motion_dimm_running):
             self.select_scene(self.default_scene)
-            self.log("Light on due to %s contact sensor" % contact_name)
+            self.trace(contact_name, 'contact open, light on')
 
     # HA Callback for motion sensors.
     def occupancy_ha_callback(self, entity, attribute, old, new, kwargs):
         # Call main processing function
-        self.occupancy_data_processing(kwargs['motion_sensor'], new)
+        self.push_occupancy(kwargs['motion_sensor'], new)
 
     # MQTT Callback for motion sensors.
-    def occupancy_mqtt_callback(self, event_name, data, kwargs):
+    def occupancy_mqtt_callback(self, payload, kwargs):
         motion_sensor = kwargs['motion_sensor']
-        payload = json.loads(data['payload'])
-        occupancy = payload.get(motion_sensor.get('monitored_field', 'occupancy'), None)
+        occupancy = payload.get(motion_sensor.field, None)
 
         # Payload does not contain occupancy data
         if occupancy is None:
             return
 
         # Call main processing function
-        self.occupancy_data_processing(kwargs['motion_sensor'], occupancy)
+        self.push_occupancy(kwargs['motion_sensor'], occupancy)
+
+    # Callback for occupancy zone transitions
+    def on_zone(self, occupied, kwargs):
+        self.push_occupancy(kwargs['motion_sensor'], occupied)
+
+    # Occupancy is processed in low priority lane - only the latest report of a sensor within a burst is processed
+    def push_occupancy(self, motion_sensor, occupancy):
+        self.low_lane.push(('motion', motion_sensor.name), self.occupancy_data_processing, motion_sensor, occupancy)
 
     # Determine, if there is any change in occupancy status for monitored devices
+    @lightmetrics.timed('occupancy_data_processing')
     def occupancy_data_processing(self, motion_sensor, occupancy):
 
-        if motion_sensor['true_value'] is not None:
-            occupancy = occupancy == motion_sensor['true_value']
-        sensor_name = motion_sensor['name']
+        if motion_sensor.true_value is not None:
+            occupancy = occupancy == motion_sensor.true_value
+        sensor_name = motion_sensor.name
 
         # No change detected
-        if self.motion_sensors[sensor_name] == occupancy:
+        previous = self.motion_sensors[sensor_name]
+        if previous == occupancy:
             return
 
-        self.log('Occupancy change for %s to %s' % (sensor_name, str(occupancy)))
+        self.trace(sensor_name, 'occupancy', previous, occupancy)
         self.motion_sensors[sensor_name] = occupancy
+        self.active_motion_sensors += (previous is False) - (occupancy is False)
+        self.last_trigger = sensor_name
 
         # --- Actual motion processing, as some change was detected ---
 
@@ -297,39 +1025,78 @@ class LightController(hass.Hass, mqtt.Mqtt):
             # Do not turn on light, when time from last turn off command via switch
             # is less than 'ignore_motion_after_turn_off_time'.
             if (time.time() - self.last_turn_off_due_to_switch) < self.ignore_motion_after_turn_off_time:
-                self.log('Light on due to motion detection ignored, '
-                         'as it is too close from turn off command via switch')
+                self.trace(sensor_name, 'motion ignored, too close to turn off via switch')
 
             # If lights are dimmed, turn them on again.
             # If timer is running in other state, then no action is needed here and timer will be canceled
             # in 'process_light_timeout' function call;
             elif self.is_motion_dimm_running:
                 self.select_scene(self.default_scene, transition=0, force=True)
-                self.log("Light on due to %s motion sensor and light in dimmed state" % sensor_name)
+                self.trace(sensor_name, 'motion in dimmed state, light on')
 
             # Simply turn on the light, if auto on is enabled
-            elif motion_sensor['turn_on']:
+            elif motion_sensor.turn_on:
                 # Check, if auto on functionality is currently enabled
-                turn_on_enable = True
-                if self.turn_on_light_enable_entity:
-                    turn_on_enable = (
-                            self.get_state(self.turn_on_light_enable_entity) == self.turn_on_light_enable_true_value)
-
-                if turn_on_enable is False:
-                    self.log("Light on due to {} ignored, as functionality is disabled via {}"
-                             .format(sensor_name, self.turn_on_light_enable_entity))
+                if self.turn_on_condition is not None and not self.turn_on_condition():
+                    self.trace(sensor_name, 'motion ignored, turn on conditions not met')
                 else:
                     self.select_scene(self.default_scene, transition=1)
-                    self.log("Light on due to %s motion sensor (turn_on flag enabled)" % sensor_name)
+                    self.trace(sensor_name, 'motion, light on')
         self.process_light_timeout()
 
+    # Compile condition into function evaluated against local cache of entity values. Condition is one of:
+    # {'all': [conditions]}, {'any': [conditions]}, {'not': condition} or entity test
+    # {'entity': ..., 'attribute': ... (optional), 'value': ...} / {..., 'below': ..., 'above': ...}.
+    def compile_condition(self, condition):
+        if 'all' in condition:
+            tests = [self.compile_condition(c) for c in condition['all']]
+            return lambda: all(test() for test in tests)
+        if 'any' in condition:
+            tests = [self.compile_condition(c) for c in condition['any']]
+            return lambda: any(test() for test in tests)
+        if 'not' in condition:
+            test = self.compile_condition(condition['not'])
+            return lambda: not test()
+        if 'entity' not in condition:
+            raise Exception("Incorrect condition {}".format(condition))
+        key = self.watch_condition_entity(condition['entity'], condition.get('attribute'))
+        values = self.condition_values
+        if 'below' in condition or 'above' in condition:
+            below = condition.get('below', float('inf'))
+            above = condition.get('above', float('-inf'))
+
+            def test():
+                try:
+                    return above < float(values[key]) < below
+                except (TypeError, ValueError):
+                    # Entity unavailable or not numeric
+                    return False
+            return test
+        if 'value' in condition:
+            value = condition['value']
+            return lambda: values[key] == value
+        raise Exception("Incorrect condition {}".format(condition))
+
+    # Keep value of entity (or its attribute) in local cache. Returns cache key.
+    def watch_condition_entity(self, entity, attribute=None):
+        key = (entity, attribute)
+        if key not in self.condition_values:
+            if self.handover is not None and key in self.handover['condition_values']:
+                self.condition_values[key] = self.handover['condition_values'][key]
+            else:
+                state = self.get_snapshot_state(entity) or dict()
+                self.condition_values[key] = state.get('state') if attribute is None else \
+                    state.get('attributes', dict()).get(attribute)
+            self.listen_state(self.on_condition_entity, entity, attribute=attribute, condition_key=key)
+        return key
+
+    def on_condition_entity(self, entity, attribute, old, new, kwargs):
+        self.condition_values[kwargs['condition_key']] = new
+
     # Check, if timer is running in dimmed state.
     @property
     def is_motion_dimm_running(self):
-        if self.timer is None:
-            return False
-        exec_time, interval, kwargs = self.info_timer(self.timer)
-        return kwargs.get('state', None) == MOTION_DIMMED
+        return self.motion_timer.phase == MOTION_DIMMED
 
     # This function is called, when the motion status is changed or the light state is changed.
     # Propose of this function is the timer control only.
@@ -342,135 +1109,169 @@ class LightController(hass.Hass, mqtt.Mqtt):
             return
 
         # Helper value to check, if in general any motion is detected.
-        all_motion_sensors_off = all([v is False for v in self.motion_sensors.values()])
+        all_motion_sensors_off = self.active_motion_sensors == 0
 
-        if self.timer is not None and (self.current_state == OFF or not all_motion_sensors_off):
+        if self.motion_timer.running and (self.current_state == OFF or not all_motion_sensors_off):
             # If timer is running and scene is OFF (so it was turned off externally) or
-            # motion is detected again (so we don't want to do any action via timer), then cancel timer.
+            # motion is detected again (so we don't want to do any action via timer), then stop timer.
             # Note: If motion was detected during dimmed state, then it will be turned on via 'on_occupancy_change'
-            self.cancel_timer(self.timer)
-            self.timer = None
-            self.log('Timer stop')
+            self.motion_timer.stop()
+            self.trace('timer', 'stop')
 
         # Timer is running in dimmed state, but state is not dimmed. Check, if it is due to transition time
         if self.is_motion_dimm_running and self.current_state != MOTION_DIMMED:
-            exec_time, interval, kwargs = self.info_timer(self.timer)
             # If state is different from undefined one (that can occur during transition time)
             # or time period is not in power off transition time
             # Note: ... plus condition from upper level, that state is not in desired one
             if self.current_state != UNDEFINED \
-                    or ((time.time() - kwargs['started']) > (self.motion_power_off_transition_time + 2)):
-                # Timer is canceled, but if no motion is detected,
+                    or ((time.time() - self.motion_timer.started) > (self.motion_power_off_transition_time + 2)):
+                # Timer is stopped, but if no motion is detected,
                 # then timer will be started over in next if statement
-                self.cancel_timer(self.timer)
-                self.timer = None
-                self.log('Timer stop due to incorrect state in timer dimmed state')
+                self.motion_timer.stop()
+                self.trace('timer', 'stop due to incorrect state in dimmed phase', details=self.current_state)
 
         # If timer is not running (so motion timeout is not running), light is on and there is no motion detected,
         # then start timeout timer.
-        if self.timer is None and self.current_state != OFF and all_motion_sensors_off:
+        if not self.motion_timer.running and self.current_state != OFF and all_motion_sensors_off:
             if self.motion_timeout == 0:
                 # Go directly to motion dimmed scene
                 self.select_motion_dimmed_scene()
-                self.log('Select directly MOTION_DIMMED scene due to motion_timeout=0.')
+                self.trace('timer', 'motion_timeout=0, dimm directly')
             else:
-                self.timer = self.run_in(self.on_timer, self.motion_timeout)
-                self.log('Timer start')
-
-    # Process timer timeout
-    def on_timer(self, kwargs):
-        if kwargs.get('state', None) == MOTION_DIMMED:
+                self.motion_timer.start(TIMEOUT, self.motion_timeout)
+                self.trace('timer', 'start', details=self.motion_timeout)
+        if self.ha_state_diagnostics:
+            self.set_ha_state()
+
+    # Process motion timer deadline
+    def on_timer(self, phase):
+        self.last_trigger = 'timer'
+        self.trace('timer', 'timeout', details=phase)
+        if phase == MOTION_DIMMED:
             # Turn off lights
-            self.timer = None
             self.select_scene(OFF)
-            self.current_state = OFF  # set current scene here due to race condition
-            self.log('Timer timeout: Select OFF scene')
         else:
             self.select_motion_dimmed_scene()
-            self.log('Timer timeout: Select MOTION_DIMMED scene')
 
     def select_motion_dimmed_scene(self):
         # Change scene to dimmed one and start timer again in dimmed mode/state
         self.select_scene(MOTION_DIMMED, transition=self.motion_power_off_transition_time)
-        self.current_state = MOTION_DIMMED  # set current scene here due to race condition
-        self.timer = self.run_in(self.on_timer, self.power_off_cancel_timeout, state=MOTION_DIMMED,
-                                 started=time.time())
+        self.motion_timer.start(MOTION_DIMMED, self.power_off_cancel_timeout)
 
     # Select default light scene and change light temperature for lights, that are on (if enabled).
     def process_default_scene(self):
-
-        if self.cold_scene_time is None or self.now_is_between(self.cold_scene_time['start'], self.cold_scene_time['end']):
+        self.update_default_scene()
+        scene = self.auto_scene_change()
+        if scene is not None:
+            self.select_scene(scene, self.auto_color_temp_change_transition)
+
+    # Times of a day, when default scene can change
+    def scene_time_boundaries(self):
+        boundaries = []
+        for scene_time in (self.cold_scene_time, self.warm_scene_time):
+            if scene_time is not None:
+                boundaries += [scene_time['start'], scene_time['end']]
+        return boundaries
+
+    def update_default_scene(self):
+        previous = self.default_scene
+        if self.cold_scene_time is None or self.is_scene_time(self.cold_scene_time):
             self.default_scene = COLD
         # If warm scene time is not defined, then WARM scene is default outside of COLD scene time
-        elif self.warm_scene_time is None or self.now_is_between(self.warm_scene_time['start'],
-                                                                 self.warm_scene_time['end']):
+        elif self.warm_scene_time is None or self.is_scene_time(self.warm_scene_time):
             self.default_scene = WARM
         else:
             self.default_scene = DIMM
-        self.log('Setting default scene to %s' % str(self.default_scene))
-
-        # Change color temperature for lights, that are on. Don't do that for WARM-DIMM transition.
+        # Circadian scene replaces COLD and WARM ones
+        if self.scene_circadian is not None and self.default_scene != DIMM:
+            self.default_scene = CIRCADIAN
+        self.trace(self.last_trigger, 'default scene', previous, self.default_scene, level=TRACE_DECISION)
+        if self.ha_state_diagnostics:
+            self.set_ha_state()
+
+    # Check, if now is within scene time window
+    def is_scene_time(self, scene_time):
+        return self.now_is_between(scene_time['start'], scene_time['end'])
+
+    # Scene to change color temperature for lights, that are on. None, if no change is needed.
+    # Don't do that for WARM-DIMM transition.
+    def auto_scene_change(self):
         if self.auto_color_temp_change:
             if self.current_state == COLD and self.default_scene == WARM:
-                self.select_scene(WARM, 30)
+                return WARM
             if self.current_state == WARM and self.default_scene == COLD:
-                self.select_scene(COLD, 30)
+                return COLD
+        if self.current_state == CIRCADIAN and self.circadian_applied is not self.scene_circadian:
+            return CIRCADIAN
+        return None
+
+    # New circadian target from the coordinator. Previous target is still detected as CIRCADIAN scene,
+    # so lights waiting for the update are not reported as UNDEFINED.
+    def set_circadian_target(self, color_temp, brightness):
+        self.scene_circadian_previous = self.scene_circadian
+        self.scene_circadian = interned(Scene, ON, brightness, color_temp if self.color_temp_support else None)
+        self.scene_index = self.build_scene_index()
+        self.update_default_scene()
+
+    # Automatic scene change requested by the coordinator (default scene boundary, circadian target):
+    # controller's method 'update' is called with given args. Returns scene for lit light or None, if no change
+    # is needed.
+    def plan_auto_change(self, trigger, update, *args):
+        self.last_trigger = trigger
+        getattr(self, update)(*args)
+        return self.auto_scene_change()
+
+    # Automatic scene change applied by the controller itself, when the coordinator runs in other thread
+    def process_auto_change(self, trigger, update, *args):
+        scene = self.plan_auto_change(trigger, update, *args)
+        if scene is not None:
+            self.select_scene(scene, self.auto_color_temp_change_transition)
+
+    # Resolve switch config into Switch with (action value, handler) of all its buttons
+    def compile_switch(self, config):
+        switch_type = config.get('type', 'aqara')
+        if switch_type not in self.switch_profiles:
+            raise Exception("Unknown switch type {}".format(switch_type))
+        actions = tuple((config.get(role, action), handler)
+                        for role, (action, handler) in self.switch_profiles[switch_type].items())
+        # Additional actions defined directly as 'action value: handler'
+        actions += tuple(config.get('actions', dict()).items())
+        return interned(Switch, config['name'], switch_type, actions)
 
     # Process mqtt payload from switch
-    def on_click(self, event_name, data, kwargs):
+    @lightmetrics.timed('on_click')
+    def on_click(self, payload, kwargs):
         # Get action (if any in payload)
-        entity = kwargs['switch']
-        payload = json.loads(data['payload'])
+        switch = kwargs['switch']
         event = payload.get('action', None)
-        if not event:
+        handler = switch.handlers.get(event)
+        if handler is None:
             return
-        self.log("Action '%s' from '%s'" % (event, entity))
-        switch = self.switches[entity]
-
-        if switch['type'] in ['philips', 'philips_bind']:
-            self.on_click_philips(switch, event)
-        elif switch['type'] == 'aqara':
-            self.on_click_aqara(switch, event)
+        self.trace(switch.name, event)
+        self.last_trigger = switch.name
+        getattr(self, handler)()
+
+    # Change scene: WARM -> COLD, COLD/OFF/DIMM/CIRCADIAN -> WARM
+    def cycle_scene(self):
+        if self.current_state == WARM:
+            self.select_scene(COLD)
+        elif self.current_state in {COLD, OFF, DIMM, CIRCADIAN}:
+            self.select_scene(WARM)
         else:
-            raise Exception('Unknown switch type {}'.format(switch['type']))
+            self.select_scene(self.default_scene)
 
-    # Processing for Aqara type switches
-    def on_click_aqara(self, switch, event):
-        # Select action
-        if event == switch[SINGLE]:
-            self.toggle_light()
-        if event == switch[DOUBLE]:
-            if self.current_state == WARM:
-                self.select_scene(COLD)
-            elif self.current_state in {COLD, OFF, DIMM}:
-                self.select_scene(WARM)
-            else:
-                self.select_scene(self.default_scene)
-        if event == switch[HOLD]:
-            if self.current_state != DIMM:
-                self.select_scene(DIMM)
-
-    # Processing for Philips Hue Dimmer Switch
-    # In case of philips switches there is no option to change buttons behavior
-    def on_click_philips(self, switch, event):
-
-        # On/Off
-        if event == 'on_press_release':
-            if switch['type'] == 'philips':
-                self.toggle_light()
-
-        # Dimmed light
-        if event in ['on_hold', 'off_hold']:
+    def select_dimm_scene(self):
+        if self.current_state != DIMM:
             self.select_scene(DIMM)
 
-        # Toggle scenes
-        if event == 'off_press_release':
-            if self.current_state == WARM:
-                self.select_scene(COLD)
-            elif self.current_state in {COLD, OFF, DIMM}:
-                self.select_scene(WARM)
-            else:
-                self.select_scene(self.default_scene)
+    def turn_on_default_scene(self):
+        if self.current_state == OFF or self.is_motion_dimm_running:
+            self.select_scene(self.default_scene)
+
+    def turn_off_light(self):
+        if self.current_state != OFF:
+            self.select_scene(OFF)
+            self.last_turn_off_due_to_switch = time.time()
 
     # Toggle light (ON-OFF)
     def toggle_light(self):
@@ -483,135 +1284,384 @@ class LightController(hass.Hass, mqtt.Mqtt):
             # (but not after motion re-detection).
             self.last_turn_off_due_to_switch = time.time()
 
-    # Callback for light state changes
+    # Callback for light state changes. Whole new state is provided, so no need to query it again.
+    @lightmetrics.timed('on_light')
     def on_light(self, entity, attribute, old, new, kwargs):
-        self.current_state = self.detect_state()
-        self.process_light_timeout()
+        # When z2m reports state directly, HA is used only as a mirror
+        if not self.mqtt_state_received:
+            self.store_light(kwargs['light'], new)
+        # HA light integration replaces attributes on each update, so controller state may need to be written again
+        self.ha_state_known[entity] = new.get('attributes', {}) if new else {}
+        self.low_lane.push('light_ha', self.process_ha_light_report)
+
+    # Callback for light state reported directly by z2m
+    @lightmetrics.timed('on_light_mqtt')
+    def on_light_mqtt(self, payload, kwargs):
+        state = payload.get('state', None)
+        if state is None:
+            # Payload does not contain light state
+            return
+        self.mqtt_state_received = True
+        self.store_light(kwargs['light'], {'state': state, 'attributes': payload})
+        self.low_lane.push('light', self.process_light_report)
+
+    # Reconcile stored state of the lights. Reports of a burst (e.g. during transition) are processed once.
+    def process_light_report(self):
+        if self.reconcile_state(self.classify_room()):
+            self.process_light_timeout()
+
+    def process_ha_light_report(self):
+        if not self.mqtt_state_received:
+            self.process_light_report()
         self.set_ha_state()
 
+    # Set expected state right after sending command, so following actions don't need to wait
+    # for the light to report it back.
+    def expect_state(self, scene, transition):
+        if scene == ON:
+            # Resulting scene is unknown
+            return
+        self.current_state = scene
+        if self.reported_state == scene and self.expected_state is None and self.pending_command is None:
+            # Nothing will be reported back, as light is already in requested state. With a command in flight
+            # or pending, the light might still report other state, so the expectation is kept.
+            self.expected_state = None
+            return
+        self.expected_state = scene
+        self.expected_state_deadline = time.time() + transition + self.state_confirm_timeout
+        if self.expected_state_timer is None:
+            self.expected_state_timer = self.run_in(self.on_expected_state_deadline,
+                                                    transition + self.state_confirm_timeout)
+
+    # Reconcile state reported by the light with expected one. Returns True, if current state was updated.
+    def reconcile_state(self, reported_state):
+        self.reported_state = reported_state
+        if self.expected_state is not None:
+            if reported_state == self.expected_state:
+                # Confirmed
+                self.expected_state = None
+            elif time.time() < self.expected_state_deadline:
+                # Transitional (UNDEFINED during transition) or stale report sent before command was executed
+                return False
+            else:
+                self.trace('light', 'expected state not confirmed', self.expected_state, reported_state,
+                           level=TRACE_DECISION)
+                self.expected_state = None
+        self.current_state = reported_state
+        return True
+
+    # Light didn't confirm expected state in time, so use the last reported one
+    def on_expected_state_deadline(self, kwargs):
+        self.expected_state_timer = None
+        if self.expected_state is None:
+            return
+        remaining = self.expected_state_deadline - time.time()
+        if remaining > 0:
+            # Newer command moved the deadline
+            self.expected_state_timer = self.run_in(self.on_expected_state_deadline, remaining)
+            return
+        if self.reconcile_state(self.reported_state):
+            self.process_light_timeout()
+            self.set_ha_state()
+
     # Callback for time based triggers - for default scene change during a day
     def on_time(self, kwargs):
-        self.log("Time triggered default scene processing.")
+        self.process_schedule()
+
+    # Default scene change at time boundary, triggered by own timer or by the coordinator
+    def process_schedule(self):
+        self.last_trigger = 'schedule'
+        self.trace('schedule', 'time trigger')
         self.process_default_scene()
 
     # Function for detecting current state, as LightController is designed to be
     # a state-less controller. Thanks to that external control via HA or custom automations is still possible.
     def detect_state(self):
-
-        state = self.get_state(self.light_entity)
-        brightness = self.get_state(self.light_entity, attribute=BRIGHTNESS)
-
-        def check_brightness(val, tolerance=1):
-            return (val - tolerance) <= brightness <= (val + tolerance)
-
-        if state.upper() == OFF:
-            detected_state = OFF
-            if self.current_state != detected_state:
-                self.log('state=%s' % detected_state)
-        elif check_brightness(self.brightness_dimmed_light) and self.is_motion_dimm_running:
-            # Lets detected MOTION_DIMMED state based on brightness and timer status.
-            # Otherwise, continue detection.
-            detected_state = MOTION_DIMMED
-            if self.current_state != detected_state:
-                self.log('state=%s, brightness=%s' % (detected_state, str(brightness)))
-        elif self.color_temp_support:
-            color_temp = self.get_state(self.light_entity, attribute=COLOR_TEMP)
-            if brightness == 0:
-                detected_state = OFF
-            elif check_brightness(self.scene_cold[BRIGHTNESS]) and color_temp == self.scene_cold[COLOR_TEMP]:
-                detected_state = COLD
-            elif check_brightness(self.scene_warm[BRIGHTNESS]) and color_temp == self.scene_warm[COLOR_TEMP]:
-                detected_state = WARM
-            elif check_brightness(self.scene_dimm[BRIGHTNESS]) and color_temp == self.scene_dimm[COLOR_TEMP]:
-                detected_state = DIMM
-            else:
-                detected_state = UNDEFINED
-            if self.current_state != detected_state:
-                self.log('state=%s, brightness=%s, color_temp=%s' % (detected_state, str(brightness), str(color_temp)))
+        for i, entity in enumerate(self.light_entities):
+            self.store_light(i, self.get_snapshot_state(entity, consume=True))
+        return self.classify_room()
+
+    # Scene from config option, missing values use given defaults
+    def config_scene(self, option, brightness, color_temp):
+        config = self.args.get(option, dict())
+        return interned(Scene, ON, config.get(BRIGHTNESS, brightness),
+                        config.get(COLOR_TEMP, color_temp) if self.color_temp_support else None)
+
+    # Index of scene signatures: (brightness, color_temp) -> scene.
+    # Circadian scene, if enabled, wins over all other scenes, so the light keeps following the sun.
+    def build_scene_index(self):
+        circadian = tuple((CIRCADIAN, scene) for scene in (self.scene_circadian_previous, self.scene_circadian)
+                          if scene is not None)
+        if not circadian:
+            return self.scenes.index
+        key = (self.scenes, circadian)
+        index = _circadian_indexes.get(key)
+        if index is None:
+            if len(_circadian_indexes) >= 64:
+                # Targets move with the sun, old ones are not needed anymore
+                _circadian_indexes.clear()
+            index = _circadian_indexes[key] = SceneTable.add_signatures(
+                dict(self.scenes.index), circadian, self.brightness_tolerance, self.color_temp_tolerance)
+        return index
+
+    # Store state of single light based on full HA state object ({'state': ..., 'attributes': {...}})
+    def store_light(self, index, light_state):
+        if not light_state:
+            self.light_brightness[index] = -1
+            self.light_color_temp[index] = -1
+            return
+        state = light_state.get('state')
+        attributes = light_state.get('attributes', {})
+        brightness = attributes.get(BRIGHTNESS)
+        color_temp = attributes.get(COLOR_TEMP) if self.color_temp_support else None
+        if state is None or state.upper() == OFF or brightness == 0:
+            self.light_brightness[index] = 0
         else:
+            # Light is on (or unavailable), but brightness can be unknown
+            self.light_brightness[index] = -1 if brightness is None else int(brightness)
+        self.light_color_temp[index] = -1 if color_temp is None else int(color_temp)
+
+    # Classify state of all lights in one pass. Lights, that are on, must be in the same scene,
+    # otherwise state is UNDEFINED. All lights off is OFF.
+    def classify_room(self):
+        detected_state = OFF
+        motion_dimmed = self.is_motion_dimm_running
+        for brightness, color_temp in zip(self.light_brightness, self.light_color_temp):
             if brightness == 0:
-                detected_state = OFF
-            elif brightness == check_brightness(self.scene_cold[BRIGHTNESS]):
-                detected_state = COLD
-            elif brightness == check_brightness(self.scene_warm[BRIGHTNESS]):
-                detected_state = WARM
-            elif brightness == check_brightness(self.scene_dimm[BRIGHTNESS]):
-                detected_state = DIMM
+                continue
+            if brightness < 0:
+                state = UNDEFINED
+            elif motion_dimmed and brightness in self.motion_dimmed_brightness_range:
+                # Lets detected MOTION_DIMMED state based on brightness and timer status.
+                # Otherwise, continue detection.
+                state = MOTION_DIMMED
             else:
+                state = self.scene_index.get((brightness, color_temp if color_temp >= 0 else None), UNDEFINED)
+            if detected_state == OFF:
+                detected_state = state
+            elif detected_state != state:
                 detected_state = UNDEFINED
-            if self.current_state != detected_state:
-                self.log('state=%s, brightness=%s' % (detected_state, str(brightness)))
+                break
+
+        if self.current_state != detected_state:
+            self.trace('light', 'state', self.current_state, detected_state,
+                       details=(self.light_brightness.tolist(), self.light_color_temp.tolist()))
         return detected_state
 
-    # Select scene by simply providing a scene name
+    # Select scene by simply providing a scene name.
+    # Commands within debounce window are coalesced (last one wins) and sent once at the end of the window.
+    @lightmetrics.timed('select_scene')
     def select_scene(self, scene, transition=0, force=False):
-        self.log('Changing scene to %s' % scene)
+        self.trace(self.last_trigger, 'select scene', self.current_state, scene, details=transition,
+                   level=TRACE_DECISION)
         now = time.time()
+        if self.is_debounced(transition, force):
+            self.trace(self.last_trigger, 'debounced', details=scene)
+            lightmetrics.count('debounced_commands')
+            self.pending_command = (scene, transition)
+            self.expect_state(scene, transition)
+            if self.pending_command_timer is None:
+                self.pending_command_timer = self.run_in(self.on_pending_command,
+                                                         self.debounce - (now - self.last_command))
+            return
+        self.send_scene(scene, transition)
+
+    # Check, if command would be coalesced with other commands in debounce window
+    def is_debounced(self, transition=0, force=False):
         # 'transition < 5' condition is for long transitions, like changing default scene.
-        if ((now - self.last_command) < self.debounce) and (transition < 5) and (not force):
-            self.log('Command debounced')
+        return ((time.time() - self.last_command) < self.debounce) and (transition < 5) and (not force)
+
+    # Send the last command requested within debounce window
+    def on_pending_command(self, kwargs):
+        self.pending_command_timer = None
+        if self.pending_command is None:
+            # Superseded by forced command
             return
-        if scene == OFF:
-            self.light_turn_off(transition=transition)
-        elif scene == ON:
-            self.light_turn_on(transition=transition)
-        elif scene == MOTION_DIMMED:
-            # For MOTION_DIMMED change brightness only, as it will preserve color temperature,
-            # that we don't want to change.
-            self.light_turn_on(transition=transition, brightness=self.brightness_dimmed_light)
-        elif self.color_temp_support:
-            if scene == COLD:
-                self.light_turn_on(transition=transition, color_temp=self.scene_cold[COLOR_TEMP],
-                                   brightness=self.scene_cold[BRIGHTNESS])
-            elif scene == WARM:
-                self.light_turn_on(transition=transition, color_temp=self.scene_warm[COLOR_TEMP],
-                                   brightness=self.scene_warm[BRIGHTNESS])
-            elif scene == DIMM:
-                self.light_turn_on(transition=transition, color_temp=self.scene_dimm[COLOR_TEMP],
-                                   brightness=self.scene_dimm[BRIGHTNESS])
-            else:
-                raise Exception('Unrecognized scene to set %s' % str(scene))
+        scene, transition = self.pending_command
+        self.pending_command = None
+        if (scene, transition) == self.last_sent_command and self.reported_state == scene:
+            # Intermediate commands cancelled each other out, the last sent command is confirmed already
+            self.expected_state = None
+            self.expect_state(scene, transition)
+            return
+        self.send_scene(scene, transition)
+
+    # Send scene to the light
+    def send_scene(self, scene, transition):
+        config = self.scene_config(scene)
+        if self.mqtt_entity or self.mqtt_entities:
+            # Payload of the scene is serialized once and shared by all instances
+            kwargs = dict(payload=config.payload(transition))
         else:
-            if scene == COLD:
-                self.light_turn_on(transition=transition, brightness=self.scene_cold[BRIGHTNESS])
-            elif scene == WARM:
-                self.light_turn_on(transition=transition, brightness=self.scene_warm[BRIGHTNESS])
-            elif scene == DIMM:
-                self.light_turn_on(transition=transition, brightness=self.scene_dimm[BRIGHTNESS])
-            else:
-                raise Exception('Unrecognized scene to set %s' % str(scene))
-        self.last_command = time.time()
+            kwargs = config.command(transition)
+        if config.state == ON:
+            self.light_turn_on(**kwargs)
+        else:
+            self.light_turn_off(**kwargs)
+        self.command_sent(scene, transition)
 
-    # Generic logic for turning on light(s)
-    def light_turn_on(self, **kwargs):
-        if self.mqtt_entity:
-            kwargs['state'] = 'ON'
-            msg = json.dumps(kwargs)
-            self.mqtt_publish(topic="zigbee2mqtt/%s/set" % self.mqtt_entity, payload=msg, namespace='mqtt')
+    # Bookkeeping after command was sent to the light - by this controller or on its behalf by the coordinator
+    def command_sent(self, scene, transition):
+        # Command sent now (by this controller or to a group) supersedes any pending one
+        self.pending_command = None
+        self.last_command = time.time()
+        self.last_sent_command = (scene, transition)
+        if scene == CIRCADIAN:
+            self.circadian_applied = self.scene_circadian
+        self.expect_state(scene, transition)
+
+    # Get Scene for given scene name
+    def scene_config(self, scene):
+        if scene == CIRCADIAN and self.scene_circadian is not None:
+            return self.scene_circadian
+        config = self.scenes.by_name.get(scene)
+        if config is None:
+            raise Exception('Unrecognized scene to set %s' % str(scene))
+        return config
+
+    # Get z2m payload for given scene
+    def scene_payload(self, scene, transition):
+        return self.scene_config(scene).payload(transition)
+
+    # Generic logic for turning on light(s). z2m payload can be provided already serialized.
+    @lightmetrics.timed('light_turn_on')
+    def light_turn_on(self, payload=None, **kwargs):
+        if self.mqtt_entity or self.mqtt_entities:
+            if payload is None:
+                kwargs['state'] = 'ON'
+                payload = json.dumps(kwargs)
+            self.mqtt_send(payload)
+        elif len(self.light_entities) > 1:
+            self.call_service('light/turn_on', entity_id=self.light_entities, **kwargs)
         else:
             self.turn_on(self.light_entity, **kwargs)
 
-    # Generic logic for turning off light(s)
-    def light_turn_off(self, **kwargs):
-        if self.mqtt_entity:
-            kwargs['state'] = 'OFF'
-            msg = json.dumps(kwargs)
-            self.mqtt_publish(topic="zigbee2mqtt/%s/set" % self.mqtt_entity, payload=msg, namespace='mqtt')
+    # Generic logic for turning off light(s). z2m payload can be provided already serialized.
+    @lightmetrics.timed('light_turn_off')
+    def light_turn_off(self, payload=None, **kwargs):
+        if self.mqtt_entity or self.mqtt_entities:
+            if payload is None:
+                kwargs['state'] = 'OFF'
+                payload = json.dumps(kwargs)
+            self.mqtt_send(payload)
+        elif len(self.light_entities) > 1:
+            self.call_service('light/turn_off', entity_id=self.light_entities, **kwargs)
         else:
             self.turn_off(self.light_entity, **kwargs)
 
+    # Send z2m command to the light (or group), in multi-light mode without group to each light
+    def mqtt_send(self, msg):
+        for entity in (self.mqtt_entity,) if self.mqtt_entity else self.mqtt_entities:
+            self.mqtt_publish(topic="zigbee2mqtt/%s/set" % entity, payload=msg, namespace='mqtt')
+
+    # Mirror controller state into HA. Nothing is written, if HA has it already.
     def set_ha_state(self):
-        if (time.time() - self.last_command) < 1 and self.current_state == UNDEFINED:
+        if self.ha_state_timer is not None:
+            # Write is scheduled and it will use the latest state
             return
-        user_friendly_mapping = {
-            DIMM: 'Dimm',
-            MOTION_DIMMED: 'MotD',
-            ON: 'On',
-            OFF: 'Off',
-            WARM: 'Warm',
-            COLD: 'Cold',
-            UNDEFINED: 'On',
-        }
-        self.set_state(self.light_entity, attributes={
-            'app_ctrl_state': user_friendly_mapping.get(self.current_state, 'Error')
-        })
+        attributes = self.ha_state_update()
+        if attributes is None:
+            lightmetrics.count('ha_state_suppressed')
+            return
+        if self.ha_state_delay:
+            self.ha_state_timer = self.run_in(self.on_ha_state_timer, self.ha_state_delay)
+        else:
+            self.write_ha_state(attributes)
+
+    def on_ha_state_timer(self, kwargs):
+        self.ha_state_timer = None
+        # State could return to the written one in the meantime
+        attributes = self.ha_state_update()
+        if attributes is not None:
+            self.write_ha_state(attributes)
+
+    # Attributes to write into HA, or None if there is nothing to write
+    def ha_state_update(self):
+        if (time.time() - self.last_command) < 1 and self.current_state == UNDEFINED:
+            # Transition in progress
+            return None
+        attributes = {'app_ctrl_state': HA_STATE_NAMES.get(self.current_state, 'Error')}
+        if self.ha_state_diagnostics:
+            attributes['app_ctrl_timer'] = self.motion_timer.phase
+            attributes['app_ctrl_timer_deadline'] = int(self.motion_timer.deadline) if self.motion_timer.running else None
+            attributes['app_ctrl_default_scene'] = self.default_scene
+            attributes['app_ctrl_trigger'] = self.last_trigger
+        for known in self.ha_state_known.values():
+            if any(known.get(name) != value for name, value in attributes.items()):
+                return attributes
+        return None
+
+    # Write attributes to light entities, that don't have them
+    def write_ha_state(self, attributes):
+        for entity, known in self.ha_state_known.items():
+            if any(known.get(name) != value for name, value in attributes.items()):
+                lightmetrics.count('ha_state_writes')
+                self.ha_state_known[entity] = attributes
+                self.set_state(entity, attributes=attributes)
+
+
+class AsyncLightController(LightController):
+    """
+    LightController with all AppDaemon callbacks running in AppDaemon event loop, so many instances share the loop
+    without hand-offs to worker threads. Controller logic is the same - AppDaemon API called from a coroutine
+    schedules the call as a task and returns its future, so commands are sent without waiting for the result.
+    """
+    motion_timer_class = AsyncMotionTimer
+    low_lane_class = AsyncLowLane
+
+    # Timer handle is a future of the handle, when timer was started from the event loop
+    def cancel_timer(self, handle):
+        if not isinstance(handle, asyncio.Future):
+            return super().cancel_timer(handle)
+        if handle.done():
+            return super().cancel_timer(handle.result())
+        handle.add_done_callback(lambda future: super(AsyncLightController, self).cancel_timer(future.result()))
+
+    # AppDaemon time API is a coroutine in the event loop, so time window is checked against local clock.
+    # Only "HH:MM:SS" times are supported.
+    def is_scene_time(self, scene_time):
+        now = datetime.datetime.fromtimestamp(time.time()).strftime('%H:%M:%S')
+        start, end = scene_time['start'], scene_time['end']
+        if start <= end:
+            return start <= now <= end
+        return now >= start or now <= end
+
+    async def on_z2m_message(self, event_name, data, kwargs):
+        super().on_z2m_message(event_name, data, kwargs)
+
+    # Calls from router, occupancy zones and coordinator are handed over into the event loop as well
+    async def on_handoff(self, kwargs):
+        super().on_handoff(kwargs)
+
+    async def on_ha_event(self, event, data, kwargs):
+        super().on_ha_event(event, data, kwargs)
+
+    async def occupancy_ha_callback(self, entity, attribute, old, new, kwargs):
+        super().occupancy_ha_callback(entity, attribute, old, new, kwargs)
+
+    async def on_condition_entity(self, entity, attribute, old, new, kwargs):
+        super().on_condition_entity(entity, attribute, old, new, kwargs)
+
+    async def on_light(self, entity, attribute, old, new, kwargs):
+        super().on_light(entity, attribute, old, new, kwargs)
+
+    async def on_expected_state_deadline(self, kwargs):
+        super().on_expected_state_deadline(kwargs)
+
+    async def on_time(self, kwargs):
+        super().on_time(kwargs)
+
+    async def on_pending_command(self, kwargs):
+        super().on_pending_command(kwargs)
+
+    async def on_ha_state_timer(self, kwargs):
+        super().on_ha_state_timer(kwargs)
+
+    async def on_save_state(self, kwargs):
+        super().on_save_state(kwargs)
+
+    async def on_state_snapshot_expired(self, kwargs):
+        super().on_state_snapshot_expired(kwargs)
+
+    async def on_trace_event(self, event, data, kwargs):
+        super().on_trace_event(event, data, kwargs)
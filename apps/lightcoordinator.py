@@ -0,0 +1,310 @@
+"""
+LightCoordinator - processes 'lightctrl.set' HA event once for all registered LightController instances.
+Lights, that get identical command, are controlled with a single message to z2m group topic (if configured),
+remaining commands are sent one by one with configurable rate, so zigbee coordinator is not flooded.
+Time based default scene changes are scheduled once for all lights and rolled out in the same way.
+Optional circadian mode precomputes color temperature/brightness curve from sun position once a day.
+
+For more info read README.md
+"""
+import appdaemon.plugins.hass.hassapi as hass
+import appdaemon.plugins.mqtt.mqttapi as mqtt
+import circadian
+from collections import deque
+import mqttrouter
+import time
+import traceback
+
+# Scene following the sun (see LightController)
+CIRCADIAN = 'CIRCADIAN'
+
+
+class CommandPacer:
+    """
+    Queue of commands executed with at most 'rate' commands per second.
+    Commands are executed in batches, so there is at most one scheduler callback per 'interval' seconds.
+    """
+
+    def __init__(self, app, rate, interval=0.1):
+        self.app = app
+        self.rate = rate  # commands per second, 0 - no limit
+        self.interval = max(interval, 1.0 / rate) if rate else 0
+        self.batch = max(1, int(round(rate * self.interval))) if rate else 0
+        self.queue = deque()
+        self.timer = None
+
+    def __len__(self):
+        return len(self.queue)
+
+    # Queue command. Without rate limit it is executed right away.
+    def push(self, callback, *args):
+        if not self.rate:
+            callback(*args)
+            return
+        self.queue.append((callback, args))
+        if self.timer is None:
+            self.on_tick(None)
+
+    def clear(self):
+        self.queue.clear()
+
+    def on_tick(self, kwargs):
+        self.timer = None
+        if not self.queue:
+            return
+        for _ in range(min(self.batch, len(self.queue))):
+            callback, args = self.queue.popleft()
+            callback(*args)
+        # Keep the timer running for one more interval even if queue is empty, so the rate is kept for next push
+        self.timer = self.app.run_in(self.on_tick, self.interval)
+
+
+class LightCoordinator(hass.Hass, mqtt.Mqtt):
+    def initialize(self):
+        """
+        Load configuration.
+        """
+        # app name -> LightController
+        self.controllers = dict()
+        # app name -> True, if controller runs in the same thread as the coordinator (see mqttrouter.runs_inline).
+        # Others process events and scene changes by themselves, in their own thread, so they are not
+        # grouped nor paced.
+        self.inline = dict()
+
+        # z2m groups: name -> members (z2m names of lights). Largest groups are tried first.
+        groups = self.args.get('groups', dict())
+        self.groups = sorted(((name, frozenset(members)) for name, members in groups.items()),
+                             key=lambda g: len(g[1]), reverse=True)
+        for name, members in self.groups:
+            self.log('Group %s: %s' % (name, ', '.join(sorted(members))))
+
+        # Rate limit for commands sent to single lights
+        self.pacer = CommandPacer(self, self.args.get('rate', 0))
+        # Rate limit for automatic color temperature changes
+        self.rollout = CommandPacer(self, self.args.get('rollout_rate', 5))
+        # Default scene time boundary -> names of controllers using it
+        self.boundaries = dict()
+
+        # Circadian mode (optional)
+        self.circadian = self.args.get('circadian', None)
+        self.circadian_names = set()  # names of controllers using circadian scene
+        self.circadian_target = None  # (color_temp, brightness)
+        self.circadian_points = deque()  # (timestamp, color_temp, brightness) change points of precomputed curve
+        self.circadian_timer = None
+        if self.circadian is not None:
+            self.circadian_location = (self.circadian.get('latitude'), self.circadian.get('longitude'))
+            if None in self.circadian_location:
+                # Fall back to Home Assistant location
+                ha_config = self.get_plugin_config()
+                self.circadian_location = (ha_config['latitude'], ha_config['longitude'])
+            self.circadian_color_temp_delta = self.circadian.get('color_temp_delta', 10)
+            self.circadian_brightness_delta = self.circadian.get('brightness_delta', 10)
+            self.log('Circadian mode at %s, %s' % self.circadian_location)
+            self.on_circadian_table(None)
+
+        self.listen_event(self.on_ha_event, event="lightctrl.set")
+
+    def register(self, controller):
+        self.controllers[controller.name] = controller
+        self.inline[controller.name] = mqttrouter.runs_inline(self, controller)
+        for boundary in controller.scene_time_boundaries():
+            if boundary not in self.boundaries:
+                self.boundaries[boundary] = set()
+                # Run shortly after the boundary, so the new default scene is already detected
+                self.run_daily(self.on_boundary, boundary, random_start=5, random_end=10, boundary=boundary)
+            self.boundaries[boundary].add(controller.name)
+        if controller.circadian:
+            if self.circadian is None:
+                raise Exception("Circadian mode is not configured in coordinator {}".format(self.name))
+            self.circadian_names.add(controller.name)
+            if self.circadian_target is not None:
+                controller.set_circadian_target(*self.circadian_target)
+
+    def unregister(self, controller):
+        self.controllers.pop(controller.name, None)
+        self.inline.pop(controller.name, None)
+        for names in self.boundaries.values():
+            names.discard(controller.name)
+        self.circadian_names.discard(controller.name)
+
+    # Process 'lightctrl.set' event for all addressed lights
+    def on_ha_event(self, event, data, kwargs):
+        action = data.get('action', None)
+        transition = data.get('transition', 0)
+        scene = data.get('scene', None)
+
+        # z2m payload -> list of (controller, scene)
+        batches = dict()
+        for controller in list(self.controllers.values()):
+            if not controller.is_event_target(data):
+                continue
+            if action == 'set_scene' and scene == CIRCADIAN and not controller.circadian:
+                # Addressed by 'all', but not in circadian mode
+                continue
+            if not self.inline[controller.name]:
+                # Controller in other thread processes the event by itself, when it is its turn in the pacer
+                self.pacer.push(self.handoff_step, controller, controller.process_event, data)
+                continue
+            # Error in one controller can't stop processing of the others
+            try:
+                self.plan_event(batches, controller, action, scene, transition)
+            except Exception:
+                self.log("Error in %s while processing %s:\n%s" % (controller.name, str(data), traceback.format_exc()),
+                         level='ERROR')
+
+        now = time.time()
+        for payload, targets in batches.items():
+            for controller, target_scene in self.send_to_groups(payload, targets, transition):
+                self.pacer.push(self.pace_step, controller, action, scene, transition, now)
+        self.log("HA event processed: %s" % str(data))
+
+    # Process event action for single controller - right away, or add its command to batches
+    def plan_event(self, batches, controller, action, scene, transition):
+        controller.last_trigger = 'event'
+        if action == 'toggle':
+            # Outcome differs per light, so there is nothing to group
+            controller.process_action(action, transition)
+            return
+        planned = controller.plan_action(action, scene)
+        if planned is None:
+            return
+        target_scene, force = planned
+        if not controller.mqtt_entity or controller.is_debounced(transition, force):
+            # Light controlled via HA or command to be coalesced by the controller itself
+            controller.select_scene(target_scene, transition, force=force)
+            return
+        self.add_to_batch(batches, controller, target_scene, transition)
+
+    # Send paced command. Action is planned again at send time, as the light might have been controlled
+    # in the meantime - newer command sent (or pending) by the controller itself wins.
+    def pace_step(self, controller, action, scene, transition, queued):
+        if not self.is_registered(controller):
+            return
+        if controller.last_command > queued or controller.pending_command is not None:
+            return
+        planned = controller.plan_action(action, scene)
+        if planned is not None:
+            controller.send_scene(planned[0], transition)
+
+    # Default scene time boundary - update default scene of all affected lights and roll out
+    # color temperature change to the lit ones
+    def on_boundary(self, kwargs):
+        queued = self.roll_out(self.boundaries[kwargs['boundary']], 'schedule', 'update_default_scene')
+        self.log("Default scene boundary %s processed, %d lights queued" % (kwargs['boundary'], queued))
+
+    # Precompute circadian change points for next 24 hours. Rebuilt once a day.
+    def on_circadian_table(self, kwargs):
+        latitude, longitude = self.circadian_location
+        table = circadian.daily_table(latitude, longitude, time.time(), self.circadian.get('step', 300),
+                                      self.circadian.get('color_temp_cold', 250),
+                                      self.circadian.get('color_temp_warm', 454),
+                                      self.circadian.get('brightness_max', 255),
+                                      self.circadian.get('brightness_min', 150))
+        self.circadian_points = deque(circadian.change_points(table, self.circadian_color_temp_delta,
+                                                              self.circadian_brightness_delta))
+        self.log('Circadian table computed, %d changes in next 24 hours' % len(self.circadian_points))
+        if self.circadian_timer is not None:
+            self.cancel_timer(self.circadian_timer)
+        self.run_in(self.on_circadian_table, 86400)
+        self.on_circadian_point(None)
+
+    # Apply the latest due change point and schedule the next one
+    def on_circadian_point(self, kwargs):
+        self.circadian_timer = None
+        now = time.time()
+        target = None
+        while self.circadian_points and self.circadian_points[0][0] <= now:
+            _, color_temp, brightness = self.circadian_points.popleft()
+            target = (color_temp, brightness)
+        if target is not None:
+            self.on_circadian_target(*target)
+        if self.circadian_points:
+            self.circadian_timer = self.run_in(self.on_circadian_point, self.circadian_points[0][0] - now)
+
+    # Update circadian target of all controllers and roll it out to lit lights in circadian scene
+    def on_circadian_target(self, color_temp, brightness):
+        if self.circadian_target is not None:
+            last_color_temp, last_brightness = self.circadian_target
+            if abs(color_temp - last_color_temp) < self.circadian_color_temp_delta \
+                    and abs(brightness - last_brightness) < self.circadian_brightness_delta:
+                # Below perceptual delta, e.g. right after the table is rebuilt
+                return
+        self.circadian_target = (color_temp, brightness)
+        queued = self.roll_out(self.circadian_names, 'circadian', 'set_circadian_target', color_temp, brightness)
+        self.log('Circadian target color_temp=%d, brightness=%d, %d lights queued' % (color_temp, brightness, queued))
+
+    # Run automatic scene change (see LightController.plan_auto_change) for controllers of given names
+    # and roll out the resulting changes of lit lights with 'rollout_rate'. Returns number of queued lights.
+    def roll_out(self, names, trigger, update, *args):
+        batches = dict()
+        queued = 0
+        for name in sorted(names):
+            controller = self.controllers.get(name)
+            if controller is None:
+                continue
+            if not self.inline[name]:
+                # Controller in other thread decides by itself, but it takes its turn in the rollout,
+                # so lights of all controllers are not changed at once
+                self.rollout.push(self.handoff_step, controller, controller.process_auto_change, trigger, update,
+                                  *args)
+                queued += 1
+                continue
+            # Error in one controller can't stop processing of the others
+            try:
+                scene = controller.plan_auto_change(trigger, update, *args)
+            except Exception:
+                self.log("Error in %s while processing %s:\n%s" % (name, trigger, traceback.format_exc()),
+                         level='ERROR')
+                continue
+            if scene is None:
+                # Light is off or change would be a no-op
+                continue
+            if not controller.mqtt_entity:
+                self.rollout.push(self.rollout_step, controller, scene)
+                queued += 1
+                continue
+            self.add_to_batch(batches, controller, scene, controller.auto_color_temp_change_transition)
+
+        for payload, targets in batches.items():
+            transition = targets[0][0].auto_color_temp_change_transition
+            for controller, scene in self.send_to_groups(payload, targets, transition):
+                self.rollout.push(self.rollout_step, controller, scene)
+                queued += 1
+        return queued
+
+    # Send queued color temperature change, unless it is not needed anymore
+    def rollout_step(self, controller, scene):
+        if self.is_registered(controller) and controller.auto_scene_change() == scene:
+            controller.send_scene(scene, controller.auto_color_temp_change_transition)
+
+    # Hand queued work over to controller's thread (see mqttrouter.call_in_thread)
+    def handoff_step(self, controller, callback, *args):
+        if self.is_registered(controller):
+            mqttrouter.call_in_thread(controller, False, callback, *args)
+
+    # Queued work is dropped, if controller was terminated (e.g. re-initialized due to config change) in the meantime
+    def is_registered(self, controller):
+        return self.controllers.get(controller.name) is controller
+
+    # Add command to batch of identical z2m payloads. Payloads are serialized once per scene,
+    # so identical scenes of different controllers give the same payload.
+    @staticmethod
+    def add_to_batch(batches, controller, scene, transition):
+        batches.setdefault(controller.scene_payload(scene, transition), []).append((controller, scene))
+
+    # Send identical payload to z2m groups, where the whole group is addressed.
+    # Returns remaining list of (controller, scene), that need to be sent one by one.
+    def send_to_groups(self, payload, targets, transition):
+        by_entity = {controller.mqtt_entity: (controller, scene) for controller, scene in targets}
+        remaining = set(by_entity)
+        for group, members in self.groups:
+            if members <= remaining:
+                self.mqtt_publish(topic="zigbee2mqtt/%s/set" % group, payload=payload, namespace='mqtt')
+                scenes = set()
+                for entity in members:
+                    controller, scene = by_entity[entity]
+                    controller.command_sent(scene, transition)
+                    scenes.add(scene)
+                remaining -= members
+                self.log('Scene %s sent to group %s' % ('/'.join(sorted(scenes)), group))
+        return [by_entity[entity] for entity in sorted(remaining)]
@@ -0,0 +1,208 @@
+"""
+LightMetrics - low-overhead, process-wide timing histograms and counters for LightController hot paths.
+LightDiagnostics app periodically publishes them as attributes of HA entity and as node_exporter textfile.
+Trace keeps recent events of a single app in a ring buffer, formatted only when they are dumped.
+
+For more info read README.md
+"""
+import appdaemon.plugins.hass.hassapi as hass
+from bisect import bisect_left
+from collections import deque
+import datetime
+from functools import wraps
+import os
+import time
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Trace record levels
+TRACE_DECISION = 1  # decisions, like scene changes
+TRACE_EVENT = 2  # processed inputs and timer changes
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. Total counts are kept for Prometheus, window counts (reset on each publish)
+    are used for rolling quantiles.
+    """
+    __slots__ = ('counts', 'window', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last bucket is +Inf
+        self.window = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect_left(BUCKETS, value)
+        self.counts[i] += 1
+        self.window[i] += 1
+        self.sum += value
+        self.count += 1
+
+    # Get window counts and start new window
+    def roll(self):
+        window = self.window
+        self.window = [0] * (len(BUCKETS) + 1)
+        return window
+
+    # Quantile estimate (bucket upper bound) from given counts
+    @staticmethod
+    def quantile(counts, q):
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = q * total
+        cumulative = 0
+        for i, c in enumerate(counts):
+            cumulative += c
+            if cumulative >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+
+
+class Metrics:
+    """
+    Registry of histograms, counters and gauges. Updates are not locked - under concurrent updates from AppDaemon
+    worker threads a sample can be lost, which is acceptable for diagnostics.
+    """
+
+    def __init__(self):
+        self.histograms = dict()
+        self.exports = dict()  # histogram name -> (Prometheus metric, label name, label value)
+        self.counters = dict()
+        self.gauges = dict()
+        self.peaks = dict()  # max value of gauge since last publish
+
+    # Histogram is exported as 'lightctrl_<metric>_seconds' with given label, by default as duration of callback
+    # of the same name
+    def histogram(self, name, metric='callback_duration', label=None):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+            self.exports[name] = (metric,) + (label or ('callback', name))
+        return h
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, delta):
+        value = self.gauges.get(name, 0) + delta
+        self.gauges[name] = value
+        if value > self.peaks.get(name, 0):
+            self.peaks[name] = value
+
+    # Get peaks of gauges and start new window
+    def roll_peaks(self):
+        peaks = self.peaks
+        self.peaks = dict(self.gauges)
+        return peaks
+
+    # Decorator measuring execution time of a function
+    def timed(self, name):
+        h = self.histogram(name)
+        perf_counter = time.perf_counter
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    h.observe(perf_counter() - start)
+            return wrapper
+        return decorator
+
+
+class Trace:
+    """
+    Bounded ring buffer of event records (time, source, decision, state before, state after, details).
+    Records are formatted only when dumped, or logged right away, if their level is within verbosity 'level'.
+    """
+    __slots__ = ('records', 'level', 'log')
+
+    def __init__(self, size, level, log):
+        self.records = deque(maxlen=size)
+        self.level = level  # 0 - nothing is logged right away
+        self.log = log
+
+    def __call__(self, source, decision, before=None, after=None, details=None, level=TRACE_EVENT):
+        record = (time.time(), source, decision, before, after, details)
+        self.records.append(record)
+        if level <= self.level:
+            self.log(self.format(record))
+
+    @staticmethod
+    def format(record):
+        t, source, decision, before, after, details = record
+        text = '%s [%s] %s' % (datetime.datetime.fromtimestamp(t).strftime('%H:%M:%S.%f')[:-3], source, decision)
+        if before is not None or after is not None:
+            text += ': %s -> %s' % (before, after)
+        if details is not None:
+            text += ' (%s)' % (details,)
+        return text
+
+    def dump(self):
+        return [self.format(record) for record in self.records]
+
+
+# Process-wide registry shared by all apps
+METRICS = Metrics()
+timed = METRICS.timed
+count = METRICS.count
+gauge = METRICS.gauge
+
+
+class LightDiagnostics(hass.Hass):
+    def initialize(self):
+        """
+        Load configuration.
+        """
+        self.entity = self.args.get('entity', 'sensor.light_controller_diagnostics')
+        self.textfile = self.args.get('textfile', None)
+        self.run_every(self.on_publish, "now", self.args.get('interval', 60))
+
+    def on_publish(self, kwargs):
+        attributes = dict(METRICS.counters)
+        for name, peak in METRICS.roll_peaks().items():
+            attributes[name] = METRICS.gauges.get(name, 0)
+            attributes['%s_max' % name] = peak
+        calls = 0
+        for name, h in sorted(METRICS.histograms.items()):
+            window = h.roll()
+            if METRICS.exports[name][0] == 'callback_duration':
+                calls += sum(window)
+            attributes['%s_count' % name] = h.count
+            for label, q in (('p50', 0.5), ('p99', 0.99)):
+                value = Histogram.quantile(window, q)
+                attributes['%s_%s_ms' % (name, label)] = None if value is None else value * 1000
+        # State is number of measured calls in last interval
+        self.set_state(self.entity, state=calls, attributes=attributes)
+        if self.textfile:
+            self.write_textfile()
+
+    # Write metrics in Prometheus text format. File is replaced atomically, as node_exporter can read it any time.
+    def write_textfile(self):
+        lines = []
+        metric = None
+        for name, h in sorted(METRICS.histograms.items(), key=lambda item: METRICS.exports[item[0]]):
+            if METRICS.exports[name][0] != metric:
+                metric = METRICS.exports[name][0]
+                lines.append('# TYPE lightctrl_%s_seconds histogram' % metric)
+            label = '%s="%s"' % METRICS.exports[name][1:]
+            cumulative = 0
+            for bound, c in zip(BUCKETS + ('+Inf',), h.counts):
+                cumulative += c
+                lines.append('lightctrl_%s_seconds_bucket{%s,le="%s"} %d' % (metric, label, bound, cumulative))
+            lines.append('lightctrl_%s_seconds_sum{%s} %f' % (metric, label, h.sum))
+            lines.append('lightctrl_%s_seconds_count{%s} %d' % (metric, label, h.count))
+        lines.append('# TYPE lightctrl_events_total counter')
+        for name, value in sorted(METRICS.counters.items()):
+            lines.append('lightctrl_events_total{event="%s"} %d' % (name, value))
+        lines.append('# TYPE lightctrl_queue_depth gauge')
+        for name, value in sorted(METRICS.gauges.items()):
+            lines.append('lightctrl_queue_depth{queue="%s"} %d' % (name, value))
+        tmp = self.textfile + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.textfile)
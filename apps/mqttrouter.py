@@ -0,0 +1,182 @@
+"""
+MqttRouter - process-wide zigbee2mqtt topic router shared by all LightController instances.
+Every topic is subscribed once and every message is decoded once, no matter how many controllers listen to it.
+Payloads without any of the fields handlers are interested in are not decoded at all.
+
+For more info read README.md
+"""
+import appdaemon.plugins.mqtt.mqttapi as mqtt
+import asyncio
+from functools import lru_cache
+import json
+import lightmetrics
+import traceback
+
+
+# z2m topic -> names of apps subscribed to it (router, occupancy zones, controllers without router).
+# AppDaemon MQTT subscriptions are shared by all apps, so topic is unsubscribed only when no app uses it anymore.
+_subscribers = dict()
+
+
+# Subscribe topic on behalf of app with given name (app itself by default)
+def subscribe_topic(app, topic, name=None):
+    subscribers = _subscribers.setdefault(topic, set())
+    if not subscribers:
+        app.mqtt_subscribe(topic, namespace='mqtt')
+    subscribers.add(name or app.name)
+
+
+# Release topic subscribed by 'subscribe_topic'. Topic is unsubscribed, when no other app uses it.
+def unsubscribe_topic(app, topic, name=None):
+    subscribers = _subscribers.get(topic)
+    if subscribers is None:
+        return
+    subscribers.discard(name or app.name)
+    if not subscribers:
+        del _subscribers[topic]
+        app.mqtt_unsubscribe(topic, namespace='mqtt')
+
+
+# Payload keys (as they appear in json) for given fields (tuple). None - payload is always decoded.
+# Keys are shared by all listeners of the same fields.
+@lru_cache(maxsize=None)
+def payload_keys(fields):
+    return None if fields is None else tuple('"%s"' % field for field in fields)
+
+
+# Decode z2m payload. Payload of attribute topic (z2m 'output: attribute') is single value, returned as
+# {attribute: value}. Json payload is decoded only, if it contains any of 'keys' - substring test is much cheaper
+# than json.loads of the whole device state. Returns None, if payload is skipped.
+def decode_payload(payload, attribute=None, keys=None):
+    if attribute is not None:
+        try:
+            return {attribute: json.loads(payload)}
+        except ValueError:
+            # Plain string value, like switch action
+            return {attribute: payload}
+    if keys is not None and not any(key in payload for key in keys):
+        lightmetrics.count('json_skipped')
+        return None
+    lightmetrics.count('json_decodes')
+    return json.loads(payload)
+
+
+# Shared apps (router, occupancy zones, coordinator) call callbacks of other apps. AppDaemon runs all callbacks
+# of an app in the thread it is pinned to (or in event loop, if they are coroutines) and apps rely on that,
+# their state is not locked. So 'owner' can be called right away from 'app' only, if both are pinned
+# to the same thread and owner doesn't run its callbacks in event loop.
+def runs_inline(app, owner):
+    if owner is app:
+        return True
+    if asyncio.iscoroutinefunction(owner.on_handoff):
+        return False
+    pin = app.get_pin_thread()
+    return pin >= 0 and pin == owner.get_pin_thread()
+
+
+# Call owner's callback in owner's thread - right away, if 'inline', otherwise it is handed over
+# via owner's scheduler and run by 'owner.on_handoff'.
+def call_in_thread(owner, inline, callback, *args):
+    if inline:
+        callback(*args)
+    else:
+        lightmetrics.count('handoffs')
+        owner.run_in(owner.on_handoff, 0, handoff=(callback, args))
+
+
+class MqttRouter(mqtt.Mqtt):
+    def initialize(self):
+        """
+        Prepare empty topic index. Controllers register their handlers in their own initialize.
+        """
+        # topic -> tuple of (owner, callback, kwargs, fields, inline)
+        # Tuples are replaced (never modified in place), so dispatch can iterate without locking.
+        self.handlers = dict()
+        # topic -> listen_event handle
+        self.listeners = dict()
+        # topic -> payload keys, any of them has to be present to decode payload (None - always decoded)
+        self.keys = dict()
+        # attribute topic -> attribute name
+        self.attributes = dict()
+        # Topics without handlers are kept subscribed for 'linger' seconds, so controller re-initialized
+        # due to config change doesn't need to subscribe them again.
+        self.linger = self.args.get('linger', 30)
+        self.lingering = set()
+        self.linger_timer = None
+
+    # Register callback for given topic. Callback is called as callback(payload, kwargs),
+    # where payload is already decoded json payload. If 'fields' are given, only payloads containing
+    # any of them are decoded. Topic of single 'attribute' is decoded into {attribute: value}.
+    # Callback runs in owner's thread (see 'runs_inline').
+    def register(self, owner, topic, callback, fields=None, attribute=None, **kwargs):
+        if topic not in self.listeners:
+            subscribe_topic(self, topic)
+            self.listeners[topic] = self.listen_event(self.on_message, "MQTT_MESSAGE", namespace='mqtt', topic=topic)
+        self.lingering.discard(topic)
+        if attribute is not None:
+            self.attributes[topic] = attribute
+        inline = runs_inline(self, owner)
+        self.handlers[topic] = self.handlers.get(topic, ()) + ((owner, callback, kwargs, fields, inline),)
+        self.update_keys(topic)
+
+    # Payload is decoded, if any handler is interested in it
+    def update_keys(self, topic):
+        fields = set()
+        for handler in self.handlers[topic]:
+            if handler[3] is None:
+                self.keys[topic] = None
+                return
+            fields.update(handler[3])
+        self.keys[topic] = payload_keys(tuple(sorted(fields)))
+
+    # Remove all callbacks registered by given owner (called from owner's terminate).
+    # With 'linger', topics nobody is interested in anymore are unsubscribed later, unless registered again.
+    def unregister(self, owner, linger=False):
+        for topic, handlers in list(self.handlers.items()):
+            remaining = tuple(h for h in handlers if h[0] is not owner)
+            if remaining:
+                self.handlers[topic] = remaining
+                self.update_keys(topic)
+                continue
+            del self.handlers[topic]
+            del self.keys[topic]
+            self.attributes.pop(topic, None)
+            if linger and self.linger:
+                self.lingering.add(topic)
+            else:
+                self.unsubscribe(topic)
+        if self.lingering and self.linger_timer is None:
+            self.linger_timer = self.run_in(self.on_linger_timeout, self.linger)
+
+    def unsubscribe(self, topic):
+        self.cancel_listen_event(self.listeners.pop(topic))
+        unsubscribe_topic(self, topic)
+
+    # Unsubscribe topics, that were not registered again
+    def on_linger_timeout(self, kwargs):
+        self.linger_timer = None
+        for topic in self.lingering:
+            if topic not in self.handlers:
+                self.unsubscribe(topic)
+        self.lingering.clear()
+
+    # Decode payload once and dispatch it to all registered handlers
+    def on_message(self, event_name, data, kwargs):
+        topic = data['topic']
+        handlers = self.handlers.get(topic)
+        if not handlers:
+            return
+        try:
+            payload = decode_payload(data['payload'], self.attributes.get(topic), self.keys.get(topic))
+        except ValueError:
+            self.log("Unable to decode payload from %s" % topic, level='WARNING')
+            return
+        if payload is None:
+            return
+        for owner, callback, callback_kwargs, _, inline in handlers:
+            # Error in one controller can't stop dispatching to the others
+            try:
+                call_in_thread(owner, inline, callback, payload, callback_kwargs)
+            except Exception:
+                self.log("Error in %s while processing %s:\n%s" % (owner.name, data['topic'], traceback.format_exc()),
+                         level='ERROR')
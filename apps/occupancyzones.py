@@ -0,0 +1,162 @@
+"""
+OccupancyZones - shared occupancy service. Motion sensor state is kept once for all LightController instances,
+sensors are grouped into zones with 'any', 'all' or 'k-of-n' semantics and only zone-level
+occupied/vacant transitions are pushed to subscribed controllers.
+
+For more info read README.md
+"""
+import appdaemon.plugins.hass.hassapi as hass
+import appdaemon.plugins.mqtt.mqttapi as mqtt
+import mqttrouter
+import traceback
+
+
+class Zone:
+    """
+    Zone occupancy with O(1) update - number of active sensors is kept incrementally.
+    """
+    __slots__ = ('name', 'sensors', 'required', 'active', 'subscribers')
+
+    def __init__(self, name, sensors, mode):
+        self.name = name
+        self.sensors = sensors
+        # Number of active sensors, that makes zone occupied
+        if mode == 'any':
+            self.required = 1
+        elif mode == 'all':
+            self.required = len(sensors)
+        else:
+            self.required = int(mode)
+        self.active = 0
+        self.subscribers = ()  # tuple of (owner, callback, kwargs, inline)
+
+    @property
+    def occupied(self):
+        return self.active >= self.required
+
+
+class Sensor:
+    """
+    Motion sensor config with defaults applied. App args are not modified.
+    """
+    __slots__ = ('name', 'type', 'true_value', 'field')
+
+    def __init__(self, config):
+        self.name = config['name']
+        self.type = config.get('type', 'mqtt')
+        # HA binary sensors report 'on'/'off' states
+        self.true_value = config.get('true_value', None if self.type == 'mqtt' else 'on')
+        self.field = config.get('monitored_field', 'occupancy')
+
+
+class OccupancyZones(hass.Hass, mqtt.Mqtt):
+    def initialize(self):
+        """
+        Load configuration.
+        """
+        # Shared MQTT router (optional)
+        self.router = None
+        if self.args.get('mqtt_router'):
+            self.router = self.get_app(self.args['mqtt_router'])
+            if self.router is None:
+                raise Exception("MQTT router app {} not found".format(self.args['mqtt_router']))
+        # z2m output type: 'json' (device state topic) or 'attribute' (topic of monitored field only)
+        self.z2m_output = self.args.get('z2m_output', 'json')
+
+        self.zones = dict()
+        self.sensors = dict()  # sensor name -> occupancy (bool)
+        self.sensor_zones = dict()  # sensor name -> list of zones
+        for zone_name, zone_config in self.args['zones'].items():
+            sensors = zone_config['sensors']
+            zone = Zone(zone_name, [s['name'] for s in sensors], zone_config.get('mode', 'any'))
+            self.zones[zone_name] = zone
+            for sensor in sensors:
+                if sensor['name'] not in self.sensors:
+                    self.add_sensor(Sensor(sensor))
+                self.sensor_zones[sensor['name']].append(zone)
+            self.log('Zone %s: %s (%d required)' % (zone_name, ', '.join(zone.sensors), zone.required))
+
+    # Subscribe to sensor once, even if it is used by many zones
+    def add_sensor(self, sensor):
+        self.sensors[sensor.name] = False  # Assume some initial condition - no motion
+        self.sensor_zones[sensor.name] = []
+        if sensor.type == 'mqtt':
+            field = sensor.field
+            topic = "zigbee2mqtt/%s" % sensor.name
+            attribute = None
+            if self.z2m_output == 'attribute':
+                topic, attribute = "%s/%s" % (topic, field), field
+            if self.router is not None:
+                self.router.register(self, topic, self.on_mqtt_sensor, fields=(field,), attribute=attribute,
+                                     sensor=sensor)
+            else:
+                # Counted in shared subscriptions, so controllers don't unsubscribe it (see mqttrouter.subscribe_topic)
+                mqttrouter.subscribe_topic(self, topic)
+                self.listen_event(self.on_mqtt_message, "MQTT_MESSAGE", namespace='mqtt', topic=topic, sensor=sensor,
+                                  z2m_attribute=attribute, z2m_keys=mqttrouter.payload_keys((field,)))
+        else:
+            self.listen_state(self.on_ha_sensor, sensor.name, sensor=sensor)
+
+    def terminate(self):
+        if self.router is not None:
+            self.router.unregister(self)
+
+    # Subscribe to zone occupancy changes. Callback is called as callback(occupied, kwargs) in owner's thread
+    # (see mqttrouter.runs_inline). Returns current zone occupancy.
+    def subscribe(self, owner, zone_name, callback, **kwargs):
+        zone = self.zones[zone_name]
+        zone.subscribers = zone.subscribers + ((owner, callback, kwargs, mqttrouter.runs_inline(self, owner)),)
+        return zone.occupied
+
+    def unsubscribe(self, owner):
+        for zone in self.zones.values():
+            zone.subscribers = tuple(s for s in zone.subscribers if s[0] is not owner)
+
+    def on_mqtt_message(self, event_name, data, kwargs):
+        payload = mqttrouter.decode_payload(data['payload'], kwargs['z2m_attribute'], kwargs['z2m_keys'])
+        if payload is not None:
+            self.on_mqtt_sensor(payload, kwargs)
+
+    def on_mqtt_sensor(self, payload, kwargs):
+        sensor = kwargs['sensor']
+        occupancy = payload.get(sensor.field, None)
+        # Payload does not contain occupancy data
+        if occupancy is None:
+            return
+        self.update(sensor, occupancy)
+
+    # Callback handed over from the router
+    def on_handoff(self, kwargs):
+        callback, args = kwargs['handoff']
+        callback(*args)
+
+    def on_ha_sensor(self, entity, attribute, old, new, kwargs):
+        self.update(kwargs['sensor'], new)
+
+    # Update sensor state and push zone transitions
+    def update(self, sensor, occupancy):
+        if sensor.true_value is not None:
+            occupancy = occupancy == sensor.true_value
+        else:
+            occupancy = occupancy is True
+        name = sensor.name
+        if self.sensors[name] == occupancy:
+            # Sensor chatter without change
+            return
+        self.sensors[name] = occupancy
+        for zone in self.sensor_zones[name]:
+            was_occupied = zone.occupied
+            zone.active += 1 if occupancy else -1
+            if zone.occupied != was_occupied:
+                self.log('Zone %s %s' % (zone.name, 'occupied' if zone.occupied else 'vacant'))
+                self.notify(zone)
+
+    def notify(self, zone):
+        occupied = zone.occupied
+        for owner, callback, kwargs, inline in zone.subscribers:
+            # Error in one controller can't stop notifying the others
+            try:
+                mqttrouter.call_in_thread(owner, inline, callback, occupied, kwargs)
+            except Exception:
+                self.log("Error in %s while processing zone %s:\n%s" % (owner.name, zone.name, traceback.format_exc()),
+                         level='ERROR')
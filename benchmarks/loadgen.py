@@ -0,0 +1,214 @@
+"""
+Synthetic zigbee2mqtt load against N LightController instances running on stand-in AppDaemon.
+Hub of benchmarks/standin.py acts as in-process MQTT broker: generated messages are published to it at offered
+rate in real (wall) time, light state echoes with transitions are produced by simulated lights in response
+to commands. Open loop - messages keep arriving on schedule even if apps fall behind, so capacity limit shows up
+as growing backlog and latency instead of lower offered rate.
+
+Load profile (json, values per room and hour, missing keys use defaults from PROFILE):
+    {"clicks": 6, "actions": {"single": 6, "double": 2, "hold": 1},
+     "pir_bursts": 20, "pir_reports": [1, 4], "pir_interval": 30,
+     "contact_flaps": 4, "contact_bounce": 0.2}
+    clicks        - switch clicks, action chosen by weights in 'actions', followed by empty action report
+    pir_bursts    - motion bursts: occupancy true repeated 'pir_reports' (min, max) times every 'pir_interval'
+                    seconds, then occupancy false
+    contact_flaps - door opened and closed again, with given probability of bounce (extra close/open pair)
+Rooms are independent with exponentially distributed gaps, seeded, so runs are repeatable.
+
+Reported:
+    offered_per_s   - rate at which messages were scheduled
+    sustained_per_s - rate at which messages (incl. light echoes) were actually processed
+    backlog_max     - max number of messages overdue plus callbacks queued or running in dispatcher
+    lag_s           - how late the last generated message was delivered
+    p50/p95/p99_ms  - from scheduled arrival of the message to outbound command, so queueing is included
+
+Usage:
+    python -m benchmarks.loadgen --instances 100 1000 --rates 500 2000 8000
+    python -m benchmarks.loadgen --profile floor.json --instances 400 --rates 1000 --modes threads async
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import random
+import time
+
+from benchmarks import replay, standin
+
+PROFILE = {
+    'clicks': 6,
+    'actions': {'single': 6, 'double': 2, 'hold': 1},
+    'pir_bursts': 20,
+    'pir_reports': [1, 4],
+    'pir_interval': 30,
+    'contact_flaps': 4,
+    'contact_bounce': 0.2,
+}
+
+
+# Arrivals of events with given rate per hour in [0, duration) seconds
+def arrivals(rng, per_hour, duration):
+    t = 0.0
+    if per_hour <= 0:
+        return
+    while True:
+        t += rng.expovariate(per_hour / 3600.0)
+        if t >= duration:
+            return
+        yield t
+
+
+# Generate messages for given number of rooms. Returns time ordered list of (t, topic, payload).
+def generate(profile, rooms, duration, seed=0):
+    rng = random.Random(seed)
+    actions, weights = zip(*sorted(profile['actions'].items()))
+    messages = []
+    for room in range(rooms):
+        switch = 'zigbee2mqtt/switch_%d' % room
+        for t in arrivals(rng, profile['clicks'], duration):
+            messages.append((t, switch, {'action': rng.choices(actions, weights)[0], 'battery': 91,
+                                         'linkquality': 60}))
+            messages.append((t + 0.3, switch, {'action': '', 'battery': 91, 'linkquality': 60}))
+
+        motion = 'zigbee2mqtt/motion_%d' % room
+        for t in arrivals(rng, profile['pir_bursts'], duration):
+            illuminance = rng.randint(0, 50)
+            reports = rng.randint(*profile['pir_reports'])
+            for i in range(reports):
+                messages.append((t + i * profile['pir_interval'], motion,
+                                 {'occupancy': True, 'illuminance': illuminance, 'battery': 97,
+                                  'linkquality': 84}))
+            messages.append((t + reports * profile['pir_interval'], motion,
+                             {'occupancy': False, 'illuminance': illuminance, 'battery': 97, 'linkquality': 84}))
+
+        door = 'zigbee2mqtt/door_%d' % room
+        for t in arrivals(rng, profile['contact_flaps'], duration):
+            opened = rng.uniform(1, 10)
+            messages.append((t, door, {'contact': False, 'battery': 100, 'linkquality': 120}))
+            if rng.random() < profile['contact_bounce']:
+                messages.append((t + 0.1, door, {'contact': True, 'battery': 100, 'linkquality': 120}))
+                messages.append((t + 0.2, door, {'contact': False, 'battery': 100, 'linkquality': 120}))
+            messages.append((t + opened, door, {'contact': True, 'battery': 100, 'linkquality': 120}))
+    messages = [(t, topic, json.dumps(payload)) for t, topic, payload in messages if t < duration]
+    messages.sort(key=lambda m: m[0])
+    return messages
+
+
+# Callbacks queued or running in dispatcher (worker threads or tasks in the event loop)
+def dispatch_backlog(hub):
+    if hub.loop is None:
+        return 0
+    return hub.in_flight + len(asyncio.all_tasks(hub.loop))
+
+
+# Let dispatcher work until wall time 'deadline' (at least one pass over the event loop)
+def pump(hub, deadline):
+    delay = max(0.0, deadline - time.perf_counter())
+    if hub.loop is not None:
+        hub.loop.run_until_complete(asyncio.sleep(delay))
+    elif delay:
+        time.sleep(delay)
+
+
+# Run single load level. Returns dict with results.
+def run(messages, instances, rate, duration, lights_per_room=1, tail=120.0, mode='direct', z2m_output='json',
+        **options):
+    hub = standin.install(standin.Hub(mode=mode, z2m_output=z2m_output))
+    modules = replay.load_apps(hub)
+    replay.build(hub, modules, instances, lights_per_room,
+                 controller_class='AsyncLightController' if mode == 'async' else 'LightController', **options)
+    hub.counters['mqtt'] = 0
+
+    # Virtual time runs faster than wall time, so that messages are offered at given rate
+    speed = len(messages) / duration / rate if rate else 1.0
+    due = [t * speed for t, _, _ in messages]  # wall time offsets of arrivals
+    begin = hub.clock
+    backlog = []
+    start = time.perf_counter()
+    for i, (t, topic, payload) in enumerate(messages):
+        arrival = start + due[i]
+        pump(hub, arrival)
+        hub.advance(begin + t)
+        overdue = bisect.bisect_right(due, time.perf_counter() - start) - i
+        backlog.append(overdue + dispatch_backlog(hub))
+        token = standin.ORIGIN.set(arrival)
+        hub.mqtt_message(topic, payload)
+        standin.ORIGIN.reset(token)
+    lag = time.perf_counter() - start - (due[-1] if due else 0.0)
+    hub.settle()
+    wall = time.perf_counter() - start
+    processed = hub.counters['mqtt']
+    # Remaining echoes and motion timeouts, not part of measured period
+    hub.advance(hub.clock + tail)
+
+    latencies = hub.latencies
+    return {
+        'mode': mode,
+        'instances': instances,
+        'offered_per_s': len(messages) / due[-1] if due and due[-1] else 0.0,
+        'inputs': len(messages),
+        'messages': processed,
+        'sustained_per_s': processed / wall if wall else 0.0,
+        'backlog_max': max(backlog) if backlog else 0,
+        'backlog_mean': sum(backlog) / len(backlog) if backlog else 0.0,
+        'lag_s': max(0.0, lag),
+        'commands': hub.counters['publish'] + hub.counters['ha_service'],
+        'p50_ms': replay.percentile(latencies, 50) * 1000,
+        'p95_ms': replay.percentile(latencies, 95) * 1000,
+        'p99_ms': replay.percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+COLUMNS = ('mode', 'instances', 'offered_per_s', 'inputs', 'messages', 'sustained_per_s', 'backlog_max',
+           'backlog_mean', 'lag_s', 'commands', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profile', help='json file with load profile (see PROFILE for defaults)')
+    parser.add_argument('--instances', type=int, nargs='+', default=[100])
+    parser.add_argument('--rates', type=float, nargs='+', default=[500, 2000, 8000],
+                        help='offered generated messages per second (wall time)')
+    parser.add_argument('--duration', type=float, default=600, help='generated period in (virtual) seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--lights-per-room', type=int, default=4)
+    parser.add_argument('--router', action='store_true', help='use shared MqttRouter')
+    parser.add_argument('--coordinator', action='store_true', help='use LightCoordinator with room groups')
+    parser.add_argument('--mqtt-state', action='store_true', help='read light state directly from z2m')
+    parser.add_argument('--zones', action='store_true', help='use OccupancyZones with one zone per room')
+    parser.add_argument('--multi-light', action='store_true', help='one controller per room driving all its lights')
+    parser.add_argument('--z2m-output', default='json', choices=['json', 'attribute'],
+                        help="z2m output type, 'attribute' subscribes per-attribute topics")
+    parser.add_argument('--lanes', action='store_true', help='enable priority lanes in controllers')
+    parser.add_argument('--pin-thread', type=int, help='pin shared apps and controllers to given worker thread')
+    parser.add_argument('--modes', nargs='+', default=['direct'], choices=['direct', 'threads', 'async'],
+                        help='callback dispatch modes to compare')
+    parser.add_argument('--json', action='store_true', help='print results as json lines')
+    args = parser.parse_args(argv)
+
+    profile = dict(PROFILE)
+    if args.profile:
+        with open(args.profile) as f:
+            profile.update(json.load(f))
+
+    results = []
+    for mode in args.modes:
+        for instances in args.instances:
+            rooms = (instances + args.lights_per_room - 1) // args.lights_per_room
+            messages = generate(profile, rooms, args.duration, args.seed)
+            for rate in args.rates:
+                result = run(messages, instances, rate, args.duration, args.lights_per_room, mode=mode,
+                             router=args.router, coordinator=args.coordinator, mqtt_state=args.mqtt_state,
+                             zones=args.zones, multi_light=args.multi_light, z2m_output=args.z2m_output,
+                             extra_args={'priority_lanes': True} if args.lanes else None,
+                             pin_thread=args.pin_thread)
+                results.append(result)
+                if args.json:
+                    print(json.dumps(result))
+    if not args.json:
+        replay.print_table(results, COLUMNS)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Measure memory and startup time of N LightController instances running on stand-in AppDaemon.
+Memory is traced with tracemalloc and only allocations made by the apps code (apps/ directory) are counted,
+so stand-in hub (HA states, listeners, timers) is not included. Startup is timed on separate build without
+tracing, as tracemalloc slows allocations down several times.
+
+Usage:
+    python -m benchmarks.memory --instances 100 500
+    python -m benchmarks.memory --instances 500 --multi-light --router --coordinator
+"""
+import argparse
+import gc
+import json
+import os
+import time
+import tracemalloc
+
+from benchmarks import replay, standin
+
+
+# Build instances and measure them. Returns dict with results.
+def run(instances, lights_per_room=1, **options):
+    hub = standin.install(standin.Hub())
+    modules = replay.load_apps(hub)
+    start = time.perf_counter()
+    replay.build(hub, modules, instances, lights_per_room, **options)
+    startup = time.perf_counter() - start
+
+    hub = standin.install(standin.Hub())
+    modules = replay.load_apps(hub)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    controllers = replay.build(hub, modules, instances, lights_per_room, **options)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    apps_filter = [tracemalloc.Filter(True, os.path.join(replay.APPS_DIR, '*'))]
+    stats = after.filter_traces(apps_filter).compare_to(before.filter_traces(apps_filter), 'filename')
+    allocated = sum(stat.size_diff for stat in stats)
+    total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return {
+        'instances': len(controllers),
+        'startup_s': startup,
+        'startup_ms_per_instance': startup / len(controllers) * 1000,
+        'apps_kb': allocated / 1024.0,
+        'apps_kb_per_instance': allocated / 1024.0 / len(controllers),
+        'total_kb_per_instance': total / 1024.0 / len(controllers),
+    }
+
+
+COLUMNS = ('instances', 'startup_s', 'startup_ms_per_instance', 'apps_kb', 'apps_kb_per_instance',
+           'total_kb_per_instance')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--instances', type=int, nargs='+', default=[100, 500])
+    parser.add_argument('--lights-per-room', type=int, default=4)
+    parser.add_argument('--router', action='store_true', help='use shared MqttRouter')
+    parser.add_argument('--coordinator', action='store_true', help='use LightCoordinator with room groups')
+    parser.add_argument('--zones', action='store_true', help='use OccupancyZones with one zone per room')
+    parser.add_argument('--multi-light', action='store_true', help='one controller per room driving all its lights')
+    parser.add_argument('--json', action='store_true', help='print results as json lines')
+    args = parser.parse_args(argv)
+
+    results = []
+    for instances in args.instances:
+        result = run(instances, args.lights_per_room, router=args.router, coordinator=args.coordinator,
+                     zones=args.zones, multi_light=args.multi_light)
+        results.append(result)
+        if args.json:
+            print(json.dumps(result))
+    if not args.json:
+        replay.print_table(results, COLUMNS)
+
+
+if __name__ == '__main__':
+    main()
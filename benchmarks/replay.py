@@ -0,0 +1,244 @@
+"""
+Replay recorded z2m/HA event trace against N LightController instances running on stand-in AppDaemon
+and report throughput and latency from incoming message to outbound command.
+
+Trace is a json-lines file. Each line is one of:
+    {"t": 0.0, "mqtt": "zigbee2mqtt/switch_{room}", "payload": {"action": "single"}}
+    {"t": 1.0, "event": "lightctrl.set", "data": {"light": "all", "action": "turn_off"}}
+    {"t": 2.0, "state": "input_boolean.auto_light", "value": "on", "attributes": {}}
+'t' is time in seconds from the trace start. '{room}' is expanded for every room, so the same trace scales
+with number of instances. Lights are grouped in rooms sharing switch, motion sensor and contact.
+
+Dispatch modes (see benchmarks/standin.py) compare threaded LightController with AsyncLightController:
+    direct  - callbacks called inline, measures controller logic only
+    threads - LightController, callbacks in worker threads, API calls handed over to the event loop
+    async   - AsyncLightController, callbacks as tasks in the event loop
+
+Usage:
+    python -m benchmarks.replay --trace benchmarks/traces/room.jsonl --instances 1 10 100 1000
+    python -m benchmarks.replay --instances 100 1000 --modes threads async
+"""
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+from benchmarks import standin
+
+APPS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'apps')
+APP_MODULES = ('lightmetrics', 'mqttrouter', 'lightcoordinator', 'occupancyzones', 'lightcontroller')
+
+
+# Import (or reload) apps bound to new stand-in hub. Returns dict: module name -> module.
+def load_apps(hub):
+    if APPS_DIR not in sys.path:
+        sys.path.insert(0, APPS_DIR)
+    modules = dict()
+    for name in APP_MODULES:
+        module = importlib.reload(sys.modules[name]) if name in sys.modules else importlib.import_module(name)
+        if hasattr(module, 'time'):
+            module.time = hub.time_module()
+        modules[name] = module
+    return modules
+
+
+# Create apps for given scenario. Returns list of LightController instances.
+def build(hub, modules, instances, lights_per_room=1, router=False, coordinator=False, mqtt_state=False,
+          zones=False, extra_args=None, controller_class='LightController', multi_light=False, pin_thread=None):
+    # Shared apps and controllers pinned to the same thread call each other directly
+    pinned = {'pin_thread': pin_thread} if pin_thread is not None else dict()
+    rooms = (instances + lights_per_room - 1) // lights_per_room
+    room_lights = [['light_%d' % i for i in range(r * lights_per_room, min(instances, (r + 1) * lights_per_room))]
+                   for r in range(rooms)]
+    if multi_light:
+        # Lights of each room are in z2m group, that is controlled by single controller
+        hub.groups.update({'room_%d' % r: lights for r, lights in enumerate(room_lights)})
+    if router:
+        modules['mqttrouter'].MqttRouter('mqtt_router', dict(pinned)).initialize()
+    if zones:
+        zones_args = {'zones': {'room_%d' % r: {'sensors': [{'name': 'motion_%d' % r}]} for r in range(rooms)}}
+        if router:
+            zones_args['mqtt_router'] = 'mqtt_router'
+        zones_args['z2m_output'] = hub.z2m_output
+        zones_args.update(pinned)
+        modules['occupancyzones'].OccupancyZones('occupancy_zones', zones_args).initialize()
+    if coordinator:
+        groups = {'room_%d' % r: lights for r, lights in enumerate(room_lights)} if not multi_light else dict()
+        hub.groups.update(groups)
+        modules['lightcoordinator'].LightCoordinator('light_coordinator', dict(pinned, groups=groups)).initialize()
+
+    # All lights exist in HA before controllers start
+    for i in range(instances):
+        hub.devices['light_%d' % i] = 'light.light_%d' % i
+        hub.set_state('light.light_%d' % i, 'off', {'brightness': None, 'color_temp': None})
+
+    controllers = []
+    for i in range(rooms if multi_light else instances):
+        room = i if multi_light else i // lights_per_room
+        if multi_light:
+            args = {
+                'light_entities': ['light.%s' % name for name in room_lights[room]],
+                'mqtt_entities': room_lights[room],
+                'mqtt_group': 'room_%d' % room,
+            }
+        else:
+            args = {
+                'light_entity': 'light.light_%d' % i,
+                'mqtt_entity': 'light_%d' % i,
+            }
+        args.update({
+            'switches': [{'name': 'switch_%d' % room}],
+            'contacts': [{'name': 'door_%d' % room}],
+            'motion_timeout': 60,
+        })
+        if zones:
+            args['motion_zones'] = [{'name': 'room_%d' % room}]
+        else:
+            args['motion_sensors'] = [{'name': 'motion_%d' % room}]
+        if router:
+            args['mqtt_router'] = 'mqtt_router'
+        if coordinator:
+            args['coordinator'] = 'light_coordinator'
+        if mqtt_state:
+            args['mqtt_state'] = True
+        args['z2m_output'] = hub.z2m_output
+        args.update(pinned)
+        args.update(extra_args or {})
+        controller = getattr(modules['lightcontroller'], controller_class)('light_ctrl_%d' % i, args)
+        controller.initialize()
+        controllers.append(controller)
+    return controllers
+
+
+def load_trace(path):
+    with open(path) as f:
+        return sorted((json.loads(line) for line in f if line.strip()), key=lambda r: r['t'])
+
+
+# Inject single trace record for all rooms. Returns number of injected inputs.
+def inject(hub, record, rooms):
+    count = 0
+    for room in range(rooms) if '{room}' in json.dumps(record) else (None,):
+        fmt = (lambda v: v.replace('{room}', str(room))) if room is not None else (lambda v: v)
+        token = standin.ORIGIN.set(time.perf_counter())
+        if 'mqtt' in record:
+            hub.mqtt_message(fmt(record['mqtt']), fmt(json.dumps(record['payload'])))
+        elif 'event' in record:
+            hub.fire(record['event'], json.loads(fmt(json.dumps(record['data']))))
+        elif 'state' in record:
+            hub.set_state(fmt(record['state']), record['value'], record.get('attributes'))
+        standin.ORIGIN.reset(token)
+        count += 1
+    # Inputs of all rooms arrive as a burst, then all resulting callbacks are processed
+    hub.settle()
+    return count
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+# Run single scenario. Returns dict with results.
+def run(trace, instances, lights_per_room=1, tail=120.0, mode='direct', z2m_output='json', **options):
+    hub = standin.install(standin.Hub(mode=mode, z2m_output=z2m_output))
+    modules = load_apps(hub)
+    start = time.perf_counter()
+    build(hub, modules, instances, lights_per_room,
+          controller_class='AsyncLightController' if mode == 'async' else 'LightController', **options)
+    startup = time.perf_counter() - start
+    rooms = (instances + lights_per_room - 1) // lights_per_room
+
+    begin = hub.clock
+    inputs = 0
+    start = time.perf_counter()
+    for record in trace:
+        hub.advance(begin + record['t'])
+        inputs += inject(hub, record, rooms)
+    hub.advance(hub.clock + tail)
+    wall = time.perf_counter() - start
+
+    latencies = hub.latencies
+    metrics = modules['lightmetrics'].METRICS
+    return {
+        'metrics': {
+            'counters': dict(metrics.counters),
+            'histograms': {name: {'count': h.count, 'mean_us': h.sum / h.count * 1e6 if h.count else 0.0}
+                           for name, h in metrics.histograms.items()},
+        },
+        'mode': mode,
+        'instances': instances,
+        'startup_s': startup,
+        'inputs': inputs,
+        'callbacks': hub.counters['callbacks'],
+        'commands': hub.counters['publish'] + hub.counters['ha_service'],
+        'get_state': hub.counters['get_state'],
+        'set_state': hub.counters['set_state'],
+        'log': hub.counters['log'],
+        'wall_s': wall,
+        'inputs_per_s': inputs / wall if wall else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+COLUMNS = ('mode', 'instances', 'startup_s', 'inputs', 'callbacks', 'commands', 'get_state', 'set_state', 'log',
+           'wall_s', 'inputs_per_s', 'p50_ms', 'p99_ms', 'max_ms')
+
+
+def print_table(results, columns=COLUMNS):
+    print(' '.join('%12s' % c for c in columns))
+    for result in results:
+        print(' '.join('%12.3f' % result[c] if isinstance(result[c], float) else '%12s' % result[c]
+                       for c in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trace', default=os.path.join(os.path.dirname(__file__), 'traces', 'room.jsonl'))
+    parser.add_argument('--instances', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--lights-per-room', type=int, default=4)
+    parser.add_argument('--router', action='store_true', help='use shared MqttRouter')
+    parser.add_argument('--coordinator', action='store_true', help='use LightCoordinator with room groups')
+    parser.add_argument('--mqtt-state', action='store_true', help='read light state directly from z2m')
+    parser.add_argument('--zones', action='store_true', help='use OccupancyZones with one zone per room')
+    parser.add_argument('--multi-light', action='store_true', help='one controller per room driving all its lights')
+    parser.add_argument('--z2m-output', default='json', choices=['json', 'attribute'],
+                        help="z2m output type, 'attribute' subscribes per-attribute topics")
+    parser.add_argument('--lanes', action='store_true', help='enable priority lanes in controllers')
+    parser.add_argument('--pin-thread', type=int, help='pin shared apps and controllers to given worker thread')
+    parser.add_argument('--metrics', action='store_true', help='print built-in hot path metrics as well')
+    parser.add_argument('--modes', nargs='+', default=['direct'], choices=['direct', 'threads', 'async'],
+                        help='callback dispatch modes to compare')
+    parser.add_argument('--json', action='store_true', help='print results as json lines')
+    args = parser.parse_args(argv)
+
+    trace = load_trace(args.trace)
+    results = []
+    for mode in args.modes:
+        for instances in args.instances:
+            result = run(trace, instances, args.lights_per_room, mode=mode, router=args.router,
+                         coordinator=args.coordinator, mqtt_state=args.mqtt_state, zones=args.zones,
+                         multi_light=args.multi_light, z2m_output=args.z2m_output,
+                         extra_args={'priority_lanes': True} if args.lanes else None, pin_thread=args.pin_thread)
+            results.append(result)
+            if args.json:
+                print(json.dumps(result))
+    if not args.json:
+        print_table(results)
+        if args.metrics:
+            for result in results:
+                print('\n%s, %d instances:' % (result['mode'], result['instances']))
+                for name, h in sorted(result['metrics']['histograms'].items()):
+                    print('%28s %8d calls %10.1f us mean' % (name, h['count'], h['mean_us']))
+                for name, value in sorted(result['metrics']['counters'].items()):
+                    print('%28s %8d' % (name, value))
+
+
+if __name__ == '__main__':
+    main()
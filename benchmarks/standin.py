@@ -0,0 +1,503 @@
+"""
+In-process stand-ins for AppDaemon Hass/Mqtt APIs used by the apps.
+Hub keeps HA states, event listeners, scheduler (virtual clock) and simulated zigbee lights,
+so apps can be run and measured without HA and MQTT broker.
+
+Callbacks are called inline by default ('direct' mode). Modes 'threads' and 'async' model AppDaemon dispatch:
+hub runs in asyncio event loop, coroutine callbacks run as tasks in the loop and other callbacks run in worker
+thread the app is pinned to, with every API call handed over to the loop and waiting for the result.
+
+Usage:
+    hub = standin.install()  # before apps are imported, then again for each new run
+    import lightcontroller
+    app = lightcontroller.LightController('light_ctrl', args)
+    app.initialize()
+"""
+import asyncio
+from collections import deque
+import contextvars
+import datetime
+import functools
+import heapq
+import itertools
+import json
+import queue
+import sys
+import threading
+import time
+import traceback
+import types
+
+# perf_counter of input, that is currently processed, None for timers
+ORIGIN = contextvars.ContextVar('origin', default=None)
+
+
+class Hub:
+    """
+    Shared state of all stand-in apps.
+    """
+
+    def __init__(self, echo_delay=0.05, report_interval=1.0, mode='direct', threads=10, z2m_output='json'):
+        self.clock = 1700000000.0  # virtual time used by apps and scheduler
+        # 'json' - device state on 'zigbee2mqtt/<name>', 'attribute' - z2m 'attribute_and_json' output,
+        # every attribute is published on 'zigbee2mqtt/<name>/<attribute>' as well
+        self.z2m_output = z2m_output
+        self.echo_delay = echo_delay  # delay between command and light state report
+        self.report_interval = report_interval  # interval of intermediate reports during transition
+
+        self.apps = dict()
+        self.states = dict()
+        self.state_listeners = dict()  # entity -> list of (handle, app, callback, attribute, kwargs)
+        # (namespace, event, topic) -> list of (handle, app, callback, kwargs). Listeners without topic filter use None.
+        # Indexing by topic keeps stand-in dispatch cost out of measurements (AppDaemon itself scans all listeners).
+        self.event_listeners = dict()
+        self.timers = []  # heap of (time, handle)
+        self.timer_callbacks = dict()  # handle -> (app, callback, interval, kwargs, time)
+        self.handles = itertools.count(1)
+        self.subscriptions = set()
+
+        # Simulated lights: z2m name -> HA entity, z2m group -> z2m names of members
+        self.devices = dict()
+        self.groups = dict()
+
+        # Statistics
+        self.latencies = []  # seconds from input to outbound command
+        self.published = deque(maxlen=1000)
+        self.counters = dict(publish=0, ha_service=0, set_state=0, get_state=0, log=0, callbacks=0, mqtt=0)
+
+        # Dispatch
+        self.mode = mode
+        self.threads = threads
+        self.loop = asyncio.new_event_loop() if mode != 'direct' else None
+        self.loop_thread = threading.get_ident()
+        self.workers = []  # queues of worker threads
+        self.in_flight = 0  # callbacks queued or running in worker threads
+        self.idle = None  # set, when there is no callback in worker threads
+
+    # Time module replacement, so apps use virtual clock
+    def time_module(self):
+        return types.SimpleNamespace(time=lambda: self.clock, sleep=lambda s: None, perf_counter=time.perf_counter)
+
+    def now(self):
+        return self.clock
+
+    # --- Inputs ---
+
+    def mqtt_message(self, topic, payload):
+        if not isinstance(payload, str):
+            payload = json.dumps(payload)
+        if self.z2m_output == 'attribute':
+            for attribute, value in json.loads(payload).items():
+                value = value if isinstance(value, str) else json.dumps(value)
+                self.fire('MQTT_MESSAGE', {'topic': '%s/%s' % (topic, attribute), 'payload': value, 'wildcard': None},
+                          namespace='mqtt')
+        self.fire('MQTT_MESSAGE', {'topic': topic, 'payload': payload, 'wildcard': None}, namespace='mqtt')
+
+    def fire(self, event, data, namespace='default'):
+        if namespace == 'mqtt':
+            self.counters['mqtt'] += 1
+        # Same as in AppDaemon - kwarg matching a key of event data is a filter
+        listeners = self.event_listeners.get((namespace, event, None), ())
+        if 'topic' in data:
+            listeners = tuple(listeners) + tuple(self.event_listeners.get((namespace, event, data['topic']), ()))
+        for handle, app, callback, kwargs in tuple(listeners):
+            if all(data[k] == v for k, v in kwargs.items() if k in data):
+                self.dispatch(app, callback, event, data, kwargs)
+
+    def set_state(self, entity, state=None, attributes=None, replace=False):
+        old = self.states.get(entity)
+        new = {
+            'entity_id': entity,
+            'state': state if state is not None else (old or {}).get('state'),
+            'attributes': dict(attributes or {}) if replace else dict((old or {}).get('attributes', {}), **(attributes or {}))
+        }
+        if old is not None and old['state'] == new['state'] and old['attributes'] == new['attributes']:
+            return
+        self.states[entity] = new
+        for handle, app, callback, attribute, kwargs in tuple(self.state_listeners.get(entity, ())):
+            if attribute == 'all':
+                old_value, new_value = old, new
+            elif attribute is None:
+                old_value, new_value = (old or {}).get('state'), new['state']
+            else:
+                old_value, new_value = (old or {}).get('attributes', {}).get(attribute), new['attributes'].get(attribute)
+            if old_value != new_value:
+                self.dispatch(app, callback, entity, attribute, old_value, new_value, kwargs)
+
+    # Terminate app and remove its listeners and timers, as AppDaemon does before the app is re-initialized
+    def stop_app(self, app):
+        app.terminate()
+        for listeners in itertools.chain(self.state_listeners.values(), self.event_listeners.values()):
+            listeners[:] = [entry for entry in listeners if entry[1] is not app]
+        for handle, entry in list(self.timer_callbacks.items()):
+            if entry[0] is app:
+                del self.timer_callbacks[handle]
+
+    # --- Dispatch ---
+
+    # Run app callback. In 'direct' mode (or for hub callbacks) it is called inline, otherwise the way AppDaemon
+    # does it: coroutine as task in the event loop, function in worker thread the app is pinned to.
+    def dispatch(self, app, callback, *args):
+        self.counters['callbacks'] += 1
+        if self.loop is None or app is None:
+            callback(*args)
+        elif asyncio.iscoroutinefunction(callback):
+            self.loop.create_task(self.guard(callback(*args)))
+        else:
+            if not self.workers:
+                self.start_workers()
+            self.in_flight += 1
+            self.workers[app.standin_thread % self.threads].put((contextvars.copy_context(), callback, args))
+
+    def start_workers(self):
+        for _ in range(self.threads):
+            tasks = queue.Queue()
+            threading.Thread(target=self.run_worker, args=(tasks,), daemon=True).start()
+            self.workers.append(tasks)
+
+    def run_worker(self, tasks):
+        while True:
+            context, callback, args = tasks.get()
+            try:
+                context.run(callback, *args)
+            except Exception:
+                traceback.print_exc()
+            self.loop.call_soon_threadsafe(self.worker_done)
+
+    def worker_done(self):
+        self.in_flight -= 1
+        if self.in_flight == 0 and self.idle is not None:
+            self.idle.set()
+
+    @staticmethod
+    async def guard(coroutine):
+        try:
+            await coroutine
+        except Exception:
+            traceback.print_exc()
+
+    # Run event loop until all dispatched callbacks (and callbacks triggered by them) are finished
+    def settle(self):
+        if self.loop is not None:
+            self.loop.run_until_complete(self.drain())
+
+    async def drain(self):
+        if self.idle is None:
+            self.idle = asyncio.Event()
+        while True:
+            await asyncio.sleep(0)
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            if tasks:
+                await asyncio.wait(tasks)
+            elif self.in_flight:
+                self.idle.clear()
+                await self.idle.wait()
+            else:
+                return
+
+    # --- Scheduler ---
+
+    def schedule(self, callback, at, interval=0, kwargs=None, app=None):
+        handle = next(self.handles)
+        self.timer_callbacks[handle] = (app, callback, interval, kwargs or {}, at)
+        heapq.heappush(self.timers, (at, handle))
+        return handle
+
+    def cancel(self, handle):
+        self.timer_callbacks.pop(handle, None)
+
+    # Advance virtual clock running all due timers
+    def advance(self, until):
+        while self.timers and self.timers[0][0] <= until:
+            at, handle = heapq.heappop(self.timers)
+            entry = self.timer_callbacks.pop(handle, None)
+            if entry is None:
+                continue
+            app, callback, interval, kwargs, _ = entry
+            self.clock = max(self.clock, at)
+            if interval:
+                self.timer_callbacks[handle] = (app, callback, interval, kwargs, at + interval)
+                heapq.heappush(self.timers, (at + interval, handle))
+            # Commands sent from timers are not reactions to inputs, so they are not counted in latency
+            ORIGIN.set(None)
+            self.dispatch(app, callback, kwargs)
+            self.settle()
+        self.clock = max(self.clock, until)
+
+    # --- Outputs ---
+
+    def publish(self, topic, payload):
+        self.counters['publish'] += 1
+        origin = ORIGIN.get()
+        if origin is not None:
+            self.latencies.append(time.perf_counter() - origin)
+        self.published.append((self.clock, topic, payload))
+        if topic.endswith('/set'):
+            name = topic[len('zigbee2mqtt/'):-len('/set')]
+            command = json.loads(payload)
+            for device in self.groups.get(name, (name,)):
+                if device in self.devices:
+                    self.light_command(device, command)
+
+    # Light service call for one entity or list of entities
+    def ha_service(self, entity, turn_on, kwargs):
+        self.counters['ha_service'] += 1
+        origin = ORIGIN.get()
+        if origin is not None:
+            self.latencies.append(time.perf_counter() - origin)
+        self.published.append((self.clock, entity, kwargs))
+        entities = set(entity) if isinstance(entity, list) else {entity}
+        for device, light_entity in self.devices.items():
+            if light_entity in entities:
+                self.light_command(device, dict(kwargs, state='ON' if turn_on else 'OFF'))
+
+    # Simulate light reaction: intermediate reports during transition and final report
+    def light_command(self, device, command):
+        entity = self.devices[device]
+        current = self.states.get(entity, {}).get('attributes', {})
+        start = current.get('brightness') or 0
+        final = {'brightness': command.get('brightness', current.get('brightness') or 254),
+                 'color_temp': command.get('color_temp', current.get('color_temp'))}
+        state = command.get('state', 'ON')
+        transition = command.get('transition', 0) or 0
+        steps = int(transition / self.report_interval)
+        for step in range(1, steps):
+            target = 0 if state == 'OFF' else final['brightness']
+            attributes = dict(final, brightness=max(1, int(start + (target - start) * step / steps)))
+            self.schedule(self.on_light_report, self.clock + self.echo_delay + step * self.report_interval,
+                          kwargs=dict(device=device, state='on', attributes=attributes))
+        if state == 'OFF':
+            final = {'brightness': None, 'color_temp': None}
+        self.schedule(self.on_light_report, self.clock + self.echo_delay + transition,
+                      kwargs=dict(device=device, state=state.lower(), attributes=final))
+
+    def on_light_report(self, kwargs):
+        device = kwargs['device']
+        self.set_state(self.devices[device], kwargs['state'], kwargs['attributes'], replace=True)
+        payload = dict(kwargs['attributes'], state=kwargs['state'].upper())
+        self.mqtt_message('zigbee2mqtt/%s' % device, payload)
+
+
+# AppDaemon API call. In worker thread it is handed over to the event loop and waits for the result.
+# Called from coroutine, it returns future (AppDaemon runs it as a task).
+def api(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        hub = self.standin_hub
+        if hub.loop is None:
+            return func(self, *args, **kwargs)
+        if threading.get_ident() != hub.loop_thread:
+            origin = ORIGIN.get()
+
+            async def call():
+                ORIGIN.set(origin)
+                return func(self, *args, **kwargs)
+            return asyncio.run_coroutine_threadsafe(call(), hub.loop).result()
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return func(self, *args, **kwargs)
+        future = hub.loop.create_future()
+        future.set_result(func(self, *args, **kwargs))
+        return future
+    return wrapper
+
+
+class StandInApp:
+    """
+    Subset of AppDaemon API (Hass and Mqtt) used by the apps.
+    """
+
+    def __init__(self, name, args=None):
+        self.standin_hub = _hub
+        self.name = name
+        self.args = args or dict()
+        self.logs = deque(maxlen=50)
+        # Worker thread the app is pinned to - round robin, unless 'pin_thread' is configured
+        self.standin_thread = self.args.get('pin_thread', len(self.standin_hub.apps)) % self.standin_hub.threads
+        self.standin_hub.apps[name] = self
+
+    def log(self, msg, *args, **kwargs):
+        self.standin_hub.counters['log'] += 1
+        self.logs.append(msg)
+
+    def error(self, msg, *args, **kwargs):
+        self.log(msg)
+
+    def get_app(self, name):
+        return self.standin_hub.apps.get(name)
+
+    # --- State ---
+
+    @api
+    def get_state(self, entity_id=None, attribute=None, default=None, namespace=None, **kwargs):
+        self.standin_hub.counters['get_state'] += 1
+        if entity_id is None:
+            return {e: s for e, s in self.standin_hub.states.items()}
+        state = self.standin_hub.states.get(entity_id)
+        if state is None:
+            return default
+        if attribute == 'all':
+            return state
+        if attribute is None:
+            return state['state']
+        return state['attributes'].get(attribute, default)
+
+    @api
+    def set_state(self, entity_id, state=None, attributes=None, namespace=None, **kwargs):
+        self.standin_hub.counters['set_state'] += 1
+        self.standin_hub.set_state(entity_id, state, attributes)
+
+    @api
+    def listen_state(self, callback, entity_id=None, attribute=None, namespace=None, **kwargs):
+        handle = next(self.standin_hub.handles)
+        self.standin_hub.state_listeners.setdefault(entity_id, []).append((handle, self, callback, attribute, kwargs))
+        return handle
+
+    @api
+    def cancel_listen_state(self, handle):
+        for listeners in self.standin_hub.state_listeners.values():
+            listeners[:] = [entry for entry in listeners if entry[0] != handle]
+
+    @api
+    def turn_on(self, entity_id, **kwargs):
+        self.standin_hub.ha_service(entity_id, True, kwargs)
+
+    @api
+    def turn_off(self, entity_id, **kwargs):
+        self.standin_hub.ha_service(entity_id, False, kwargs)
+
+    @api
+    def call_service(self, service, **kwargs):
+        domain, action = service.split('/')
+        if domain == 'light' and action in ('turn_on', 'turn_off'):
+            self.standin_hub.ha_service(kwargs.pop('entity_id'), action == 'turn_on', kwargs)
+
+    # --- Events ---
+
+    @api
+    def listen_event(self, callback, event=None, namespace='default', **kwargs):
+        handle = next(self.standin_hub.handles)
+        key = (namespace, event, kwargs.get('topic'))
+        self.standin_hub.event_listeners.setdefault(key, []).append((handle, self, callback, kwargs))
+        return handle
+
+    @api
+    def cancel_listen_event(self, handle):
+        for listeners in self.standin_hub.event_listeners.values():
+            listeners[:] = [entry for entry in listeners if entry[0] != handle]
+
+    @api
+    def fire_event(self, event, namespace='default', **kwargs):
+        self.standin_hub.fire(event, kwargs, namespace=namespace)
+
+    # --- Scheduler ---
+
+    # In 'direct' mode all apps run in single thread
+    def get_pin_thread(self):
+        return 0 if self.standin_hub.loop is None else self.standin_thread
+
+    @api
+    def run_in(self, callback, delay, **kwargs):
+        hub = self.standin_hub
+        if delay <= 0 and hub.loop is not None:
+            # Due right away - AppDaemon runs it as soon as the app's thread is free, virtual clock doesn't matter
+            hub.dispatch(self, callback, kwargs)
+            return next(hub.handles)
+        return hub.schedule(callback, hub.clock + delay, kwargs=kwargs, app=self)
+
+    @api
+    def run_every(self, callback, start, interval, **kwargs):
+        start = self.standin_hub.clock if start == 'now' else self.standin_hub.clock + interval
+        return self.standin_hub.schedule(callback, start, interval=interval, kwargs=kwargs, app=self)
+
+    @api
+    def run_daily(self, callback, start, random_start=0, random_end=0, **kwargs):
+        # Random offset is replaced with deterministic one
+        offset = (random_start + random_end) / 2.0
+        return self.standin_hub.schedule(callback, self.next_time(start) + offset, interval=24 * 3600, kwargs=kwargs,
+                                         app=self)
+
+    @api
+    def cancel_timer(self, handle):
+        self.standin_hub.cancel(handle)
+
+    @api
+    def timer_running(self, handle):
+        return handle in self.standin_hub.timer_callbacks
+
+    @api
+    def info_timer(self, handle):
+        app, callback, interval, kwargs, at = self.standin_hub.timer_callbacks[handle]
+        return datetime.datetime.fromtimestamp(at), interval, kwargs
+
+    @api
+    def datetime(self):
+        return datetime.datetime.fromtimestamp(self.standin_hub.clock)
+
+    def next_time(self, start):
+        now = datetime.datetime.fromtimestamp(self.standin_hub.clock)
+        t = datetime.datetime.strptime(start, '%H:%M:%S').time() if isinstance(start, str) else start
+        at = datetime.datetime.combine(now.date(), t)
+        if at <= now:
+            at += datetime.timedelta(days=1)
+        return at.timestamp()
+
+    @api
+    def now_is_between(self, start, end):
+        now = datetime.datetime.fromtimestamp(self.standin_hub.clock).time()
+        start = datetime.datetime.strptime(start, '%H:%M:%S').time()
+        end = datetime.datetime.strptime(end, '%H:%M:%S').time()
+        if start <= end:
+            return start <= now <= end
+        return now >= start or now <= end
+
+    # --- MQTT ---
+
+    @api
+    def mqtt_subscribe(self, topic, namespace=None, **kwargs):
+        self.standin_hub.subscriptions.add(topic)
+
+    @api
+    def mqtt_unsubscribe(self, topic, namespace=None, **kwargs):
+        self.standin_hub.subscriptions.discard(topic)
+
+    @api
+    def mqtt_publish(self, topic, payload=None, namespace=None, **kwargs):
+        self.standin_hub.publish(topic, payload)
+
+
+_hub = None
+
+
+# Install stand-in modules as 'appdaemon.plugins.hass.hassapi' and 'appdaemon.plugins.mqtt.mqttapi'
+# and set new hub. Apps created afterwards (as App(name, args)) are bound to this hub.
+def install(hub=None):
+    global _hub
+    _hub = hub or Hub()
+    if 'appdaemon.plugins.hass.hassapi' in sys.modules:
+        return _hub
+
+    class Hass(StandInApp):
+        pass
+
+    class Mqtt(StandInApp):
+        pass
+
+    modules = {
+        'appdaemon': types.ModuleType('appdaemon'),
+        'appdaemon.plugins': types.ModuleType('appdaemon.plugins'),
+        'appdaemon.plugins.hass': types.ModuleType('appdaemon.plugins.hass'),
+        'appdaemon.plugins.hass.hassapi': types.ModuleType('appdaemon.plugins.hass.hassapi'),
+        'appdaemon.plugins.mqtt': types.ModuleType('appdaemon.plugins.mqtt'),
+        'appdaemon.plugins.mqtt.mqttapi': types.ModuleType('appdaemon.plugins.mqtt.mqttapi'),
+    }
+    modules['appdaemon.plugins.hass.hassapi'].Hass = Hass
+    modules['appdaemon.plugins.mqtt.mqttapi'].Mqtt = Mqtt
+    modules['appdaemon'].plugins = modules['appdaemon.plugins']
+    modules['appdaemon.plugins'].hass = modules['appdaemon.plugins.hass']
+    modules['appdaemon.plugins'].mqtt = modules['appdaemon.plugins.mqtt']
+    modules['appdaemon.plugins.hass'].hassapi = modules['appdaemon.plugins.hass.hassapi']
+    modules['appdaemon.plugins.mqtt'].mqttapi = modules['appdaemon.plugins.mqtt.mqttapi']
+    sys.modules.update(modules)
+    return _hub
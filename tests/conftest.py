@@ -0,0 +1,70 @@
+"""
+Apps running on stand-in AppDaemon (benchmarks/standin.py) with virtual clock and simulated zigbee lights.
+Lights echo commands after 'echo_delay', so tests check commands sent and the resulting controller state.
+"""
+import copy
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import replay, standin  # noqa: E402
+
+
+# Dispatch mode can be chosen by indirect parametrization, e.g. 'async' for controllers in the event loop
+@pytest.fixture
+def hub(request):
+    hub = standin.install(standin.Hub(mode=getattr(request, 'param', 'direct')))
+    yield hub
+    if hub.loop is not None:
+        hub.loop.close()
+
+
+@pytest.fixture
+def apps(hub):
+    return replay.load_apps(hub)
+
+
+# Build controllers of given scenario (see benchmarks.replay.build). Room 'r' has 'switch_r', 'motion_r'
+# and 'door_r', light 'i' is 'light.light_i' in HA and 'light_i' in z2m.
+@pytest.fixture
+def build(hub, apps):
+    def build(instances=1, **options):
+        options.setdefault('controller_class', 'AsyncLightController' if hub.mode == 'async' else 'LightController')
+        return replay.build(hub, apps, instances, **options)
+    return build
+
+
+# Re-initialize controller with changed args, as AppDaemon does on config change. Returns the new instance.
+@pytest.fixture
+def reload(hub, apps):
+    def reload(controller, **changes):
+        args = copy.deepcopy(controller.args)
+        args.update(changes)
+        hub.stop_app(controller)
+        new = type(controller)(controller.name, args)
+        new.initialize()
+        return new
+    return reload
+
+
+# Commands sent to z2m topic of given light (or group): list of (time, payload)
+def commands(hub, name='light_0'):
+    topic = 'zigbee2mqtt/%s/set' % name
+    return [(t, json.loads(payload)) for t, to, payload in hub.published if to == topic]
+
+
+def click(hub, action='single', switch='switch_0'):
+    hub.mqtt_message('zigbee2mqtt/%s' % switch, {'action': action})
+
+
+def motion(hub, occupancy, sensor='motion_0'):
+    hub.mqtt_message('zigbee2mqtt/%s' % sensor, {'occupancy': occupancy})
+
+
+# Advance virtual clock by given seconds, running all due callbacks
+def wait(hub, seconds):
+    hub.settle()
+    hub.advance(hub.clock + seconds)
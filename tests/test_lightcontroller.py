@@ -0,0 +1,237 @@
+import os
+
+from conftest import click, commands, motion, wait
+
+WARM = {'state': 'ON', 'brightness': 255, 'color_temp': 389}
+COLD = {'state': 'ON', 'brightness': 255, 'color_temp': 250}
+DIMM = {'state': 'ON', 'brightness': 76, 'color_temp': 400}
+
+
+def scene(payload):
+    return {key: payload[key] for key in ('state', 'brightness', 'color_temp') if key in payload}
+
+
+def test_click_turns_light_on_and_light_confirms_it(hub, build):
+    controller, = build()
+    assert controller.current_state == 'OFF'
+    click(hub)
+    assert [scene(p) for _, p in commands(hub)] == [WARM]
+    assert controller.current_state == 'WARM'
+    assert controller.expected_state == 'WARM'
+    wait(hub, 1)
+    assert controller.current_state == 'WARM'
+    assert controller.expected_state is None
+
+
+# --- Debounce ---
+
+def test_clicks_within_debounce_are_coalesced_into_last_one(hub, build):
+    controller, = build()
+    click(hub)
+    wait(hub, 0.2)
+    click(hub, 'double')  # WARM -> COLD
+    wait(hub, 0.2)
+    click(hub, 'hold')  # DIMM
+    assert len(commands(hub)) == 1
+    assert controller.current_state == 'DIMM'
+    wait(hub, 2)
+    sent = commands(hub)
+    assert [scene(p) for _, p in sent] == [WARM, DIMM]
+    # Pending command is sent at the end of debounce window
+    assert sent[1][0] - sent[0][0] == controller.debounce
+    assert controller.current_state == 'DIMM'
+
+
+def test_commands_cancelling_each_other_out_are_not_sent(hub, build):
+    controller, = build()
+    click(hub)
+    wait(hub, 0.2)
+    click(hub, 'double')  # WARM -> COLD
+    wait(hub, 0.2)
+    click(hub, 'double')  # COLD -> WARM
+    wait(hub, 2)
+    assert [scene(p) for _, p in commands(hub)] == [WARM]
+    assert controller.current_state == 'WARM'
+    assert controller.expected_state is None
+
+
+def test_forced_command_is_not_debounced(hub, build):
+    controller, = build()
+    click(hub)
+    wait(hub, 0.2)
+    hub.fire('lightctrl.set', {'light': 'light_0', 'action': 'force_turn_on'})
+    assert len(commands(hub)) == 2
+    assert controller.pending_command is None
+
+
+# --- Expected state ---
+
+def test_stale_report_does_not_override_expected_state(hub, build):
+    controller, = build()
+    click(hub)
+    wait(hub, 2)
+    click(hub)  # turn off
+    # Report sent by the light before the command was executed
+    hub.set_state('light.light_0', 'on', {'brightness': 200, 'color_temp': 389}, replace=True)
+    assert controller.current_state == 'OFF'
+    wait(hub, 1)
+    assert controller.current_state == 'OFF'
+    assert controller.expected_state is None
+
+
+def test_report_of_command_in_flight_does_not_override_pending_one(hub, build):
+    controller, = build()
+    click(hub)
+    wait(hub, 2)
+    click(hub)  # turn off
+    wait(hub, 0.01)
+    click(hub)  # turn on again - pending, as it is within debounce window, light is still reported WARM
+    wait(hub, 0.1)
+    # Light reported OFF as the result of the first command
+    assert controller.reported_state == 'OFF'
+    assert controller.current_state == 'WARM'
+    wait(hub, 2)
+    assert [scene(p) for _, p in commands(hub)] == [WARM, {'state': 'OFF'}, WARM]
+    assert controller.current_state == 'WARM'
+
+
+def test_external_change_is_detected(hub, build):
+    controller, = build()
+    click(hub)
+    wait(hub, 2)
+    hub.set_state('light.light_0', 'on', dict(COLD, state=None), replace=True)
+    assert controller.current_state == 'COLD'
+
+
+def test_unconfirmed_command_falls_back_to_reported_state(hub, build):
+    controller, = build()
+    # Light doesn't react
+    del hub.devices['light_0']
+    click(hub)
+    assert controller.current_state == 'WARM'
+    wait(hub, controller.state_confirm_timeout + 0.1)
+    assert controller.current_state == 'OFF'
+    assert controller.expected_state is None
+
+
+# --- Motion ---
+
+def test_motion_turns_light_on_and_timer_dims_and_turns_it_off(hub, build):
+    controller, = build()
+    motion(hub, True)
+    assert [scene(p) for _, p in commands(hub)] == [WARM]
+    motion(hub, False)
+    wait(hub, controller.motion_timeout - 1)
+    assert len(commands(hub)) == 1
+    wait(hub, 2)
+    assert scene(commands(hub)[-1][1]) == {'state': 'ON', 'brightness': controller.brightness_dimmed_light}
+    wait(hub, controller.motion_power_off_transition_time + 1)
+    assert controller.current_state == 'MOTION_DIMMED'
+    wait(hub, controller.power_off_cancel_timeout)
+    assert scene(commands(hub)[-1][1]) == {'state': 'OFF'}
+    wait(hub, controller.motion_power_off_transition_time + 1)
+    assert controller.current_state == 'OFF'
+    assert not controller.motion_timer.running
+
+
+def test_motion_in_dimmed_phase_turns_light_on_again(hub, build):
+    controller, = build()
+    motion(hub, True)
+    motion(hub, False)
+    wait(hub, controller.motion_timeout + controller.motion_power_off_transition_time + 2)
+    assert controller.current_state == 'MOTION_DIMMED'
+    motion(hub, True)
+    assert scene(commands(hub)[-1][1]) == WARM
+    wait(hub, 2)
+    assert controller.current_state == 'WARM'
+    assert not controller.motion_timer.running
+
+
+def test_motion_right_after_switch_turn_off_is_ignored(hub, build):
+    controller, = build()
+    click(hub)
+    wait(hub, 2)
+    click(hub)  # turn off
+    wait(hub, 1)
+    motion(hub, True)
+    assert [scene(p) for _, p in commands(hub)] == [WARM, {'state': 'OFF'}]
+    assert controller.current_state == 'OFF'
+
+
+# --- Config reload ---
+
+def test_reload_keeps_light_state_and_motion_timer(hub, build, reload):
+    controller, = build()
+    motion(hub, True)
+    motion(hub, False)
+    wait(hub, 10)
+    deadline = controller.motion_timer.deadline
+    get_state_calls = hub.counters['get_state']
+    controller = reload(controller, scene_warm={'brightness': 200})
+    # Light state is handed over, not queried again
+    assert hub.counters['get_state'] == get_state_calls
+    assert controller.motion_timer.deadline == deadline
+    # Scene tables of the new config are applied to the kept light state
+    assert controller.current_state == 'UNDEFINED'
+    wait(hub, controller.motion_timeout - 10 + 1)
+    assert scene(commands(hub)[-1][1]) == {'state': 'ON', 'brightness': controller.brightness_dimmed_light}
+
+
+def test_reload_keeps_pending_command(hub, build, reload):
+    controller, = build()
+    click(hub)
+    wait(hub, 0.2)
+    click(hub, 'hold')
+    controller = reload(controller, trace_size=50)
+    wait(hub, 2)
+    assert [scene(p) for _, p in commands(hub)] == [WARM, DIMM]
+    assert controller.current_state == 'DIMM'
+
+
+def test_reload_unsubscribes_topics_of_removed_devices_only(hub, build, reload):
+    # Two lights in one room share the switch
+    first, second = build(2, lights_per_room=2)
+    first = reload(first, switches=[{'name': 'switch_new'}])
+    assert 'zigbee2mqtt/switch_0' in hub.subscriptions
+    assert 'zigbee2mqtt/switch_new' in hub.subscriptions
+    second = reload(second, switches=[{'name': 'switch_new'}])
+    assert 'zigbee2mqtt/switch_0' not in hub.subscriptions
+    click(hub, switch='switch_new')
+    assert first.current_state == second.current_state == 'WARM'
+
+
+def test_topic_of_occupancy_zones_is_kept_subscribed(hub, apps, build, reload):
+    apps['occupancyzones'].OccupancyZones('occupancy_zones', {
+        'zones': {'hall': {'sensors': [{'name': 'pir_hall'}]}}}).initialize()
+    controller, = build(extra_args={'motion_sensors': [{'name': 'pir_hall'}]})
+    reload(controller, motion_sensors=[{'name': 'motion_0'}])
+    assert 'zigbee2mqtt/pir_hall' in hub.subscriptions
+
+
+def test_handover_of_removed_app_expires(hub, apps, build):
+    first, second = build(2)
+    hub.stop_app(second)  # removed from config
+    assert second.name in apps['lightcontroller']._handover
+    wait(hub, second.state_max_age + 1)
+    hub.stop_app(first)
+    assert second.name not in apps['lightcontroller']._handover
+    assert 'zigbee2mqtt/switch_1' not in hub.subscriptions
+
+
+# --- Persisted state ---
+
+def test_state_dir_is_created(hub, build, tmp_path):
+    state_dir = str(tmp_path / 'missing' / 'state')
+    controller, = build(extra_args={'state_dir': state_dir, 'state_save_interval': 5})
+    motion(hub, True)
+    wait(hub, 6)
+    assert os.listdir(state_dir) == ['light_ctrl_0.json']
+
+
+def test_state_write_error_is_logged(hub, build, tmp_path):
+    state_dir = tmp_path / 'state'
+    controller, = build(extra_args={'state_dir': str(state_dir)})
+    os.rmdir(state_dir)
+    state_dir.write_text('')  # not a directory anymore
+    hub.stop_app(controller)
+    assert 'Unable to save state' in controller.logs[-1]
@@ -0,0 +1,95 @@
+import datetime
+
+import pytest
+
+from conftest import click, commands, wait
+
+WARM_EVENT = {'light': 'all', 'action': 'set_scene', 'scene': 'WARM'}
+
+
+# Replace rate limits of the coordinator built by replay.build
+def set_rates(apps, coordinator, rate=0, rollout_rate=0):
+    coordinator.pacer = apps['lightcoordinator'].CommandPacer(coordinator, rate)
+    coordinator.rollout = apps['lightcoordinator'].CommandPacer(coordinator, rollout_rate)
+
+
+def light_commands(hub, instances):
+    return sorted(t for i in range(instances) for t, _ in commands(hub, 'light_%d' % i))
+
+
+def test_lights_of_group_get_single_command(hub, build):
+    controllers = build(4, lights_per_room=4, coordinator=True)
+    hub.fire('lightctrl.set', WARM_EVENT)
+    assert len(commands(hub, 'room_0')) == 1
+    assert light_commands(hub, 4) == []
+    wait(hub, 1)
+    assert [c.current_state for c in controllers] == ['WARM'] * 4
+
+
+def test_error_in_one_controller_does_not_stop_the_others(hub, build, monkeypatch):
+    controllers = build(3, coordinator=True)
+
+    def fail(*args):
+        raise Exception('broken')
+    monkeypatch.setattr(controllers[1], 'plan_action', fail)
+    hub.fire('lightctrl.set', WARM_EVENT)
+    wait(hub, 1)
+    assert [c.current_state for c in controllers] == ['WARM', 'OFF', 'WARM']
+    assert any('broken' in line for line in controllers[0].coordinator.logs)
+
+
+def test_paced_command_is_dropped_when_light_was_controlled(hub, apps, build):
+    first, second = build(2, coordinator=True)
+    coordinator = first.coordinator
+    coordinator.groups = []
+    set_rates(apps, coordinator, rate=1)
+    hub.fire('lightctrl.set', WARM_EVENT)
+    assert len(light_commands(hub, 2)) == 1
+    wait(hub, 0.1)
+    click(hub, 'hold', switch='switch_1')  # DIMM, before its turn in the pacer
+    wait(hub, 2)
+    assert second.current_state == 'DIMM'
+    assert len(commands(hub, 'light_1')) == 1
+
+
+# Controllers in the event loop don't run in the coordinator's thread, so they get the work handed over
+@pytest.mark.parametrize('hub', ['async'], indirect=True)
+def test_event_for_controllers_in_other_thread_is_paced(hub, apps, build):
+    controllers = build(10, coordinator=True)
+    set_rates(apps, controllers[0].coordinator, rate=2)
+    hub.fire('lightctrl.set', WARM_EVENT)
+    wait(hub, 10)
+    sent = light_commands(hub, 10)
+    assert len(sent) == 10
+    assert min(b - a for a, b in zip(sent, sent[1:])) >= 0.5
+    assert [c.current_state for c in controllers] == ['WARM'] * 10
+
+
+@pytest.mark.parametrize('hub', ['async'], indirect=True)
+def test_paced_work_of_unregistered_controller_is_dropped(hub, apps, build):
+    controllers = build(4, coordinator=True)
+    set_rates(apps, controllers[0].coordinator, rate=1)
+    hub.fire('lightctrl.set', WARM_EVENT)
+    hub.settle()
+    hub.stop_app(controllers[3])
+    wait(hub, 5)
+    assert len(light_commands(hub, 4)) == 3
+    assert controllers[3].current_state == 'OFF'
+
+
+@pytest.mark.parametrize('hub', ['direct', 'async'], indirect=True)
+def test_default_scene_change_is_rolled_out(hub, apps, build):
+    day = datetime.datetime.fromtimestamp(hub.clock).date() + datetime.timedelta(days=1)
+    hub.clock = datetime.datetime.combine(day, datetime.time(6, 40)).timestamp()
+    controllers = build(6, coordinator=True, extra_args={'motion_timeout': 7200})
+    coordinator = controllers[0].coordinator
+    coordinator.groups = []
+    set_rates(apps, coordinator, rollout_rate=2)
+    hub.fire('lightctrl.set', WARM_EVENT)
+    wait(hub, 60)
+    hub.published.clear()
+    wait(hub, 15 * 60)
+    sent = light_commands(hub, 6)
+    assert len(sent) == 6
+    assert min(b - a for a, b in zip(sent, sent[1:])) >= 0.5
+    assert [c.current_state for c in controllers] == ['COLD'] * 6
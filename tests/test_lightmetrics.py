@@ -0,0 +1,15 @@
+from conftest import motion, wait
+
+
+def test_lane_wait_is_exported_apart_from_callback_durations(hub, apps, build, tmp_path):
+    build(2, lights_per_room=2, extra_args={'priority_lanes': True})
+    motion(hub, True)
+    motion(hub, False)  # queued in low priority lane
+    wait(hub, 1)
+    textfile = tmp_path / 'lightcontroller.prom'
+    apps['lightmetrics'].LightDiagnostics('light_diagnostics', {'textfile': str(textfile)}).initialize()
+    wait(hub, 0)
+    lines = textfile.read_text().splitlines()
+    assert 'lightctrl_lane_wait_seconds_count{lane="low"} 2' in lines
+    assert not any('lane_low_wait' in line for line in lines)
+    assert 'lightctrl_callback_duration_seconds_count{callback="occupancy_data_processing"} 4' in lines